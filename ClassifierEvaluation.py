@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def confusion_matrix(true_labels, predicted_labels, num_classes):
+    """
+    Counts the samples of every (true class, predicted class) pair in a single bincount.
+    :param true_labels: true class indices
+    :param predicted_labels: predicted class indices
+    :param num_classes: Number of classes
+    :return: (num_classes x num_classes) array, rows are true classes and columns are predicted classes
+    """
+    true_labels = np.asarray(true_labels, dtype=int)
+    predicted_labels = np.asarray(predicted_labels, dtype=int)
+    assert true_labels.shape == predicted_labels.shape
+
+    counts = np.bincount(true_labels * num_classes + predicted_labels, minlength=num_classes * num_classes)
+    return counts.reshape((num_classes, num_classes))
+
+
+def evaluate(true_labels, predicted_labels, num_classes):
+    """
+    Evaluates predictions against the true labels.
+    :param true_labels: true class indices (or one-hot labels)
+    :param predicted_labels: predicted class indices
+    :param num_classes: Number of classes
+    :return: dict with the 'confusion_matrix', the per-class 'num_samples' and 'num_errors', and the 'accuracy'
+    """
+    true_labels = np.asarray(true_labels)
+    if true_labels.ndim == 2:
+        true_labels = np.argmax(true_labels, 1)
+
+    matrix = confusion_matrix(true_labels, predicted_labels, num_classes)
+    num_samples = np.sum(matrix, axis=1)
+    num_errors = num_samples - np.diag(matrix)
+    accuracy = np.trace(matrix) / float(max(np.sum(num_samples), 1))
+
+    return {'confusion_matrix': matrix, 'num_samples': num_samples, 'num_errors': num_errors, 'accuracy': accuracy}
+
+
+def print_errors(sports, evaluation):
+    """
+    Prints the number of errors, the number of samples and the row of the confusion matrix of every class.
+    :param sports: List of names of activities in data set
+    :param evaluation: result of evaluate
+    :return: Nothing
+    """
+    for i in range(len(sports)):
+        print sports[i] + ':\t', evaluation['num_errors'][i], '/', evaluation['num_samples'][i], '\t', \
+            evaluation['confusion_matrix'][i, :]
+
+
+def evaluate_and_print(sports, true_labels, predicted_labels):
+    """
+    Evaluates predictions (see evaluate) and prints the errors of every class (see print_errors).
+    :param sports: List of names of activities in data set
+    :param true_labels: true class indices (or one-hot labels)
+    :param predicted_labels: predicted class indices
+    :return: result of evaluate
+    """
+    evaluation = evaluate(true_labels, predicted_labels, len(sports))
+    print_errors(sports, evaluation)
+    return evaluation
@@ -3,8 +3,24 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import numpy as np
 import tensorflow as tf
+from sklearn.decomposition import PCA, IncrementalPCA
+from multiprocessing.pool import ThreadPool
+import collections
+import hashlib
+import os
 import sys
 
+# parsed or memory-mapped feature files shared by all load_data calls of this process, most recently loaded last
+_loaded_files = collections.OrderedDict()
+_max_loaded_files = 4
+
+# per-channel PCAs fitted by fit_channel_pcas in this process, keyed by the content of the training features
+_fitted_pcas = collections.OrderedDict()
+_max_fitted_pcas = 4
+
+
+# matmul of batches of matrices (tf.matmul handles batches itself in later tensorflow versions)
+batch_matmul = getattr(tf, 'batch_matmul', tf.matmul)
 
 def weight_var(shape):
     return tf.Variable(tf.truncated_normal(shape, stddev=0.1))
@@ -20,64 +36,101 @@ def max_pool(x):
     # 2x2 max pooling
     return tf.nn.max_pool(x, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
 
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    # tensorflow session configuration with the given thread pool sizes (0 lets tensorflow pick)
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
 def sample_fractions(labels):
     N, C = labels.shape
-    fractions = np.zeros(C)
     if N==0:
-        return fractions
-
-    for i in range(C):
-        fractions[i] = np.sum(np.equal(labels[:, i], np.ones(N)))
-    fractions /= N
-
-    return fractions
-
-def load_data(features_csv, labels_csv, newPerson=False):
+        return np.zeros(C)
+
+    return np.sum(labels == 1, axis=0) / float(N)
+
+def stratified_split(labels, train_fraction, seed=None):
+    # splits sample indices into shuffled train and test sets whose class fractions match the overall ones
+    # (up to rounding), in a single pass over per-class index lists; the same seed gives the same split
+    rng = np.random.RandomState(seed)
+    N = labels.shape[0]
+    classes = np.argmax(labels, 1)
+    num_train = int(np.floor(train_fraction * N))
+
+    class_indices = [np.flatnonzero(classes == c) for c in range(labels.shape[1])]
+    class_counts = np.array([len(indices) for indices in class_indices])
+
+    # train samples per class, rounded so that they add up to num_train (largest remainders get the extra ones)
+    exact = train_fraction * class_counts
+    class_train_counts = np.floor(exact).astype(int)
+    remainders = np.argsort(-(exact - class_train_counts), kind='mergesort')
+    class_train_counts[remainders[:max(0, num_train - np.sum(class_train_counts))]] += 1
+
+    train_indices = []
+    test_indices = []
+    for indices, count in zip(class_indices, class_train_counts):
+        indices = rng.permutation(indices)
+        train_indices.append(indices[:count])
+        test_indices.append(indices[count:])
+
+    train_indices = rng.permutation(np.concatenate(train_indices))
+    test_indices = rng.permutation(np.concatenate(test_indices))
+    return train_indices, test_indices
+
+def load_array(file_name, dtype, cache=True):
+    # loads a .csv file, or memory-maps a .npy file, and keeps it for later calls (read-only) if cache is True
+    key = (os.path.abspath(file_name), os.path.getsize(file_name), os.path.getmtime(file_name), dtype)
+    if key in _loaded_files:
+        return _loaded_files[key]
+
+    if file_name.endswith('.npy'):
+        array = np.load(file_name, mmap_mode='r')
+        if array.dtype.kind != 'f' or np.dtype(dtype).kind != 'f':
+            array = array.astype(dtype) # only (float32 or float64) features stay memory-mapped
+    else:
+        array = np.loadtxt(file_name, dtype=dtype, delimiter=', ')
+
+    if cache:
+        array.flags.writeable = False
+        _loaded_files[key] = array
+        while len(_loaded_files) > _max_loaded_files:
+            _loaded_files.popitem(last=False)
+    return array
+
+def clear_loaded_files():
+    # forgets the files kept by load_array
+    _loaded_files.clear()
+
+def load_data(features_csv, labels_csv, newPerson=False, cache=True, seed=None, indicesOnly=False):
     # loads data as a dictionary of numpy arrays
+    # features_csv and labels_csv may be .csv files or .npy files (see FeatureExtraction outputFormat='npy'),
+    # the latter are memory-mapped and only the rows of the train and test sets are read
+    # seed makes the train/test split reproducible
+    # with indicesOnly, the dictionary holds the full (possibly memory-mapped) 'features' and 'labels' along with
+    # 'train_indices' and 'test_indices' instead of the split arrays, so that callers can slice the rows they need
     data = {}
 
     data_split = np.array([80.0,20.0]) # split sizes for train and test sets
     if newPerson:
         data_split = np.array([0.0, 100.0])
 
-    features = np.loadtxt(features_csv, dtype='float', delimiter=', ')
-    labels = np.loadtxt(labels_csv, dtype='int', delimiter=', ')
+    features = load_array(features_csv, 'float', cache=cache)
+    labels = load_array(labels_csv, 'int', cache=cache)
 
     assert features.shape[0] == labels.shape[0] # sanity check
 
-    N, D = features.shape
-    _, C = labels.shape
+    train_indices, test_indices = stratified_split(labels, data_split[0] / np.sum(data_split), seed=seed)
 
-    index_test_start = np.floor((data_split[0] / np.sum(data_split)) * N).astype(int)
+    if indicesOnly:
+        data['features']      = features
+        data['labels']        = labels
+        data['train_indices'] = train_indices
+        data['test_indices']  = test_indices
+        return data
 
-    fractions_overall = sample_fractions(labels)
-
-    shuffled_order = None
-    shuffled_labels = None
-    while True:
-        shuffled_order = np.random.permutation(N)
-        shuffled_labels = labels[shuffled_order]
-
-        if newPerson:
-            break
-        else:
-            train_fractions = sample_fractions(shuffled_labels[:index_test_start])
-            test_fractions = sample_fractions(shuffled_labels[index_test_start:])
-
-            ssd_train = np.sum((train_fractions - fractions_overall) ** 2)
-            ssd_test = np.sum((test_fractions - fractions_overall) ** 2)
-            if ssd_train<0.0005 and ssd_test<0.0005:
-                break
-
-    assert shuffled_order is not None
-    assert shuffled_labels is not None
-
-    shuffled_features = features[shuffled_order]
-
-    data['train_features'] = shuffled_features[:index_test_start]
-    data['train_labels']   = shuffled_labels[:index_test_start]
-    data['test_features']  = shuffled_features[index_test_start:]
-    data['test_labels']    = shuffled_labels[index_test_start:]
+    data['train_features'] = features[train_indices]
+    data['train_labels']   = labels[train_indices]
+    data['test_features']  = features[test_indices]
+    data['test_labels']    = labels[test_indices]
 
     return data
 
@@ -98,6 +151,97 @@ def get_data_folds(k, num_folds, features, labels):
 
     return train_fold_features, train_fold_labels, val_fold_features, val_fold_labels
 
+def stratified_folds(labels, num_folds):
+    # returns the (training indices, validation indices) of each of num_folds folds, computed once, so that the
+    # models can gather the rows of a fold straight from the unmodified feature array
+    # every class is dealt round-robin over the folds, and indices stay in ascending order
+    classes = np.argmax(labels, 1)
+    fold_of_sample = np.zeros(labels.shape[0], dtype=int)
+    offset = 0
+    for c in range(labels.shape[1]):
+        class_indices = np.flatnonzero(classes == c)
+        fold_of_sample[class_indices] = (offset + np.arange(len(class_indices))) % num_folds
+        offset += len(class_indices)
+
+    return [(np.flatnonzero(fold_of_sample != k), np.flatnonzero(fold_of_sample == k)) for k in range(num_folds)]
+
+def fit_channel_pcas(features, num_components, backend='auto', indices=None, num_threads=None, chunk_size=1000,
+                     cache=True):
+    # fits a PCA with num_components components to each channel (last axis) of features (only to the rows in indices,
+    # if given), as a list of PCAs
+    # backend is the svd_solver of sklearn's PCA ('auto', 'full' or 'randomized'), or 'incremental' for an
+    # IncrementalPCA that is fitted chunk_size rows at a time, so that memory-mapped features are read chunk by chunk
+    # and never held in memory as a whole
+    # the channels are fitted in parallel on num_threads threads (None for one per channel)
+    # the PCAs are fitted without whitening and kept for later calls on the same features if cache is True, so that
+    # project_channels can serve any smaller number of components, whitened or not, from a single fit
+    key = (features_key(features, indices), backend)
+    if key in _fitted_pcas and _fitted_pcas[key][0].n_components_ >= num_components:
+        _fitted_pcas[key] = _fitted_pcas.pop(key)
+        return _fitted_pcas[key]
+
+    if indices is None:
+        indices = np.arange(features.shape[0])
+    channels = features.shape[2]
+    pool = ThreadPool(channels if num_threads is None else num_threads)
+
+    if backend == 'incremental':
+        pcas = [IncrementalPCA(n_components=num_components) for c in range(channels)]
+        # every chunk needs at least num_components rows, so a short last chunk is merged into the one before
+        chunk_size = max(chunk_size, num_components)
+        chunk_starts = range(0, max(len(indices) - num_components, 1), chunk_size) + [len(indices)]
+        for start, end in zip(chunk_starts[:-1], chunk_starts[1:]):
+            chunk = features[indices[start:end]]
+            pool.map(lambda c: pcas[c].partial_fit(chunk[:, :, c]), range(channels))
+    else:
+        train_features = features[indices]
+        pcas = pool.map(lambda c: PCA(n_components=num_components, svd_solver=backend).fit(train_features[:, :, c]),
+                        range(channels))
+    pool.close()
+
+    if cache:
+        _fitted_pcas.pop(key, None)
+        _fitted_pcas[key] = pcas
+        while len(_fitted_pcas) > _max_fitted_pcas:
+            _fitted_pcas.popitem(last=False)
+    return pcas
+
+def project_channels(features, pcas, num_components, whiten=True, indices=None, chunk_size=1000):
+    # projects each channel of features (only the rows in indices, if given) onto the first num_components components
+    # of its PCA (see fit_channel_pcas), scaled to unit variance if whiten is True
+    # rows are read chunk_size at a time, so that memory-mapped features are never held in memory as a whole
+    if indices is None:
+        indices = np.arange(features.shape[0])
+    reduced_features = np.zeros((len(indices), num_components, features.shape[2]))
+
+    for start in range(0, len(indices), chunk_size):
+        chunk = features[indices[start:start + chunk_size]]
+        for c in range(features.shape[2]):
+            reduced_features[start:start + chunk_size, :, c] = np.dot(chunk[:, :, c] - pcas[c].mean_,
+                                                                      pcas[c].components_[:num_components].T)
+
+    if whiten:
+        for c in range(features.shape[2]):
+            reduced_features[:, :, c] /= np.sqrt(pcas[c].explained_variance_[:num_components])
+    return reduced_features
+
+def features_key(features, indices=None):
+    # identifies the rows in indices (all rows if None) of features: memory-mapped features by their file, others by
+    # their content
+    digest = hashlib.sha1(str(features.shape))
+    if isinstance(features, np.memmap):
+        digest.update('%s:%d:%f' % (os.path.abspath(features.filename), os.path.getsize(features.filename),
+                                    os.path.getmtime(features.filename)))
+    else:
+        digest.update(np.ascontiguousarray(features))
+    if indices is not None:
+        digest.update(np.ascontiguousarray(indices))
+    return digest.hexdigest()
+
+def clear_fitted_pcas():
+    # forgets the PCAs kept by fit_channel_pcas
+    _fitted_pcas.clear()
+
 class Logger(object):
     """
     Logger class to print stdout messages into a log file while displaying them in stdout also.
@@ -2,13 +2,30 @@ import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import numpy as np
+import cStringIO
 import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
 
 def data_preprocessing(sports=['Badminton','Basketball','Foosball','Running','Skating','Walking'],
                        secondsToKeep=30,
                        trimLength=15,
-                       switchAlgo=0):
+                       switchAlgo=0,
+                       mode='lines',
+                       chunkSize=100000,
+                       numWorkers=1,
+                       outputNames=None,
+                       cacheDir=None,
+                       cacheFingerprint='stat',
+                       cacheMaxBytes=2 * 1024 ** 3,
+                       binaryOutput=False,
+                       workerPool=None):
     """
     Pre-processes the raw data files to make sure the data from both sensors is of the same size.
     Discards some amount of raw data at the start and end of the files to remove miscellaneous activity
@@ -23,151 +40,715 @@ def data_preprocessing(sports=['Badminton','Basketball','Foosball','Running','Sk
         -- 2: [NEWPERSON/TEST] create for newPerson and singleTest for separate testing (use with 0)
         -- 3: [NEWPERSON/TEST] create only for singleTest for separate testing (use with 4)
         -- 4: [FINAL/TRAINING] create original + newPerson for training (use with 3)
+        A list of testing scenarios (e.g. [0, 2]) creates all of them in a single pass over the raw data files.
+    :param mode: how each raw file is processed...
+        -- 'lines':  [DEFAULT] handles the raw file as a list of text lines
+        -- 'arrays': loads the raw file once into a NumPy array of lines and aligns, trims and cuts the sensor
+                     streams with vectorized index math (same output as 'lines', much faster on long recordings)
+        -- 'stream': reads the raw file in chunks of chunkSize lines and writes the samples out as it goes, so that
+                     memory use depends on chunkSize and not on the length of the recording (same output as 'lines')
+    :param chunkSize: Number of lines read at a time in 'stream' mode
+    :param numWorkers: Number of worker processes that pre-process the raw files in parallel (1 for serial)
+    :param outputNames: dict from testing scenario to the name of its output file in each sport directory
+                        (defaults to 'Final.csv' for 0, 1 and 4 and 'newPersonFinal.csv' for 2 and 3). Names must
+                        contain 'Final', so that the outputs are not taken for raw data files.
+    :param cacheDir: Directory in which the pre-processed samples of every raw file are cached (None for no cache).
+                     Only new or changed raw files are pre-processed again, and outputs whose raw files did not
+                     change at all are not rewritten.
+    :param cacheFingerprint: how a raw file is recognized in the cache...
+        -- 'stat':    [DEFAULT] by its path, size and modification time
+        -- 'content': by a hash of its contents
+    :param cacheMaxBytes: size cap of cacheDir in bytes (None for no cap). The least recently used samples that this
+                          call does not use are removed once the cache grows beyond it.
+    :param binaryOutput: Set True to also write each output as float32 arrays that FeatureExtraction can memory-map:
+                         <output>_Acc.npy and <output>_Gyro.npy, along with a <output>.json header that records the
+                         sensor order and the block lengths
+    :param workerPool: multiprocessing.Pool of numWorkers processes to pre-process with, instead of one that is
+                       created and closed in every call (it is left open)
     :return: Nothing
     """
+    switchAlgos = switchAlgo if isinstance(switchAlgo, (list, tuple)) else [switchAlgo]
+
+    finalOutputNames = []
+    for algo in switchAlgos:
+        if outputNames is not None and algo in outputNames:
+            finalOutputNames.append(outputNames[algo])
+        elif algo==2 or algo==3:
+            finalOutputNames.append('newPersonFinal.csv')
+        else:
+            finalOutputNames.append('Final.csv')
+    for name in finalOutputNames:
+        # outputs are written next to the raw files, which are told apart from them by 'Final' in their names
+        if 'Final' not in name:
+            raise ValueError('Output name ' + name + ' does not contain \'Final\', so it would be read back as raw '
+                             'data')
+    if len(set(finalOutputNames)) < len(finalOutputNames):
+        raise ValueError('Testing scenarios ' + str(switchAlgos) + ' write to the same output files ' +
+                         str(finalOutputNames) + ', pass outputNames to tell them apart')
+
+    # raw files of each sport that belong to any of the requested testing scenarios (in glob order)
+    recordings = {}
     for sport in sports:
-        source_dir      = '../Data/' + sport
-        finalOutputFile = '../Data/' + sport + '/Final.csv'
-        if switchAlgo==2 or switchAlgo==3:
-            finalOutputFile = '../Data/' + sport + '/newPersonFinal.csv'
-        outputFileAcc   = finalOutputFile[:len(finalOutputFile)-4]+'_Acc'+finalOutputFile[len(finalOutputFile)-4:]
-        outputFileGyro  = finalOutputFile[:len(finalOutputFile)-4]+'_Gyro'+finalOutputFile[len(finalOutputFile)-4:]
+        recordings[sport] = [fileName for fileName in glob.glob('../Data/' + sport + '/*.csv')
+                             if any(recording_in_split(fileName, algo) for algo in switchAlgos)]
 
-        file_list = glob.glob(source_dir + '/*.csv')
+    # parallel and cached modes: each raw file is pre-processed into its own pair of files (in a temporary
+    # directory, or in cacheDir where they are kept between runs), which are then merged below in the same
+    # order as in the serial mode
+    tempDir = None
+    try:
+        partFiles = None
+        if numWorkers > 1 or cacheDir is not None:
+            partDir = cacheDir
+            if cacheDir is None:
+                tempDir = tempfile.mkdtemp(prefix='preprocessing_', dir='../Data')
+                partDir = tempDir
+            elif not os.path.exists(cacheDir):
+                os.makedirs(cacheDir)
 
-        with open(outputFileAcc,'w') as outFileAcc:
-            with open(outputFileGyro,'w') as outFileGyro:
-                for i in range(len(file_list)):
-                    # avoiding files with 'Final' in its name
-                    if 'Final' in file_list[i]:
+            partFiles = {}
+            tasks = []
+            for sport in sports:
+                for i in range(len(recordings[sport])):
+                    fileName = recordings[sport][i]
+                    if cacheDir is None:
+                        partName = sport + '_' + str(i)
+                    else:
+                        partName = recording_fingerprint(fileName, secondsToKeep, trimLength, cacheFingerprint)
+                    partFiles[fileName] = (os.path.join(partDir, partName + '_Acc.csv'),
+                                           os.path.join(partDir, partName + '_Gyro.csv'))
+
+                    if cacheDir is not None and os.path.exists(partFiles[fileName][0]) \
+                            and os.path.exists(partFiles[fileName][1]):
+                        print '\nFile:', fileName, '(cached)'
+                        # the modification time of the cached files is their last use (see evict_cache)
+                        for partFile in partFiles[fileName]:
+                            os.utime(partFile, None)
                         continue
+                    tasks.append((fileName, partFiles[fileName][0], partFiles[fileName][1],
+                                  secondsToKeep, trimLength, mode, chunkSize))
 
-                    if switchAlgo==0:
-                        # avoiding files with 'newPerson' or 'singleTest' in its name
-                        if 'newPerson' in file_list[i] or 'singleTest' in file_list[i]:
-                            continue
-                    elif switchAlgo==2:
-                        # taking only files with 'newPerson' or 'singleTest' in its name
-                        if 'newPerson' not in file_list[i] and 'singleTest' not in file_list[i]:
-                            continue
-                    elif switchAlgo==3:
-                        # taking only files with 'singleTest' in its name
-                        if 'singleTest' not in file_list[i]:
-                            continue
-                    elif switchAlgo==4:
-                        # avoid files 'singleTest' in its name
-                        if 'singleTest' in file_list[i]:
+            # the workers return what they would print, which is printed here in task order (their own stdout may
+            # not be the one of this process, e.g. a Logger set up after the pool was created)
+            if numWorkers > 1 and len(tasks) > 1:
+                pool = workerPool if workerPool is not None else multiprocessing.Pool(numWorkers)
+                try:
+                    for messages in pool.map(preprocess_recording_to_files, tasks, chunksize=1):
+                        sys.stdout.write(messages)
+                    if workerPool is None:
+                        pool.close()
+                        pool.join()
+                except:
+                    pool.terminate()
+                    pool.join()
+                    raise
+            else:
+                for task in tasks:
+                    sys.stdout.write(preprocess_recording_to_files(task))
+
+        for sport in sports:
+            finalOutputFiles = ['../Data/' + sport + '/' + name for name in finalOutputNames]
+            outputFilesAcc   = [f[:len(f)-4]+'_Acc'+f[len(f)-4:] for f in finalOutputFiles]
+            outputFilesGyro  = [f[:len(f)-4]+'_Gyro'+f[len(f)-4:] for f in finalOutputFiles]
+
+            file_list = recordings[sport]
+
+            if partFiles is not None:
+                for k in range(len(finalOutputFiles)):
+                    splitPartFiles = [partFiles[fileName] for fileName in file_list
+                                      if recording_in_split(fileName, switchAlgos[k])]
+                    manifestFile = None
+                    if cacheDir is not None:
+                        manifestFile = os.path.join(cacheDir, sport + '_' + finalOutputNames[k] + '.manifest')
+                        if output_up_to_date(finalOutputFiles[k], manifestFile, splitPartFiles):
+                            print '\nUp to date:', finalOutputFiles[k]
+                            if binaryOutput and not os.path.exists(finalOutputFiles[k][:-4] + '.json'):
+                                write_binary_output(finalOutputFiles[k], [f[0] for f in splitPartFiles],
+                                                    [f[1] for f in splitPartFiles], chunkSize=chunkSize)
                             continue
 
-                    with open(file_list[i], 'r') as fileStream:
-                        counter=1
-                        firstSensor  = "Accelerometer"
-                        secondSensor = "Gyroscope"
-
-                        print '\nFile:', file_list[i]
-
-                        firstLine=fileStream.readline()
-                        firstWord=firstLine.split(', ')[0]
-
-                        if "gyro" in firstWord.lower():
-                            firstSensor = "Gyroscope"
-
-                        while True:
-                            line=fileStream.readline()
-                            currFirstWord=line.split(', ')[0]
-                            if firstWord==currFirstWord:
-                                counter+=1
-                            else:
-                                break
-
-                        line=fileStream.readline()
-                        firstWord=line.split(', ')[0]
-
-                        if "accel" in firstWord.lower():
-                            secondSensor = "Accelerometer"
-
-                        fileStream.seek(0)
-                        lines           = fileStream.readlines()
-                        totalNumOfLines = len(lines)
-                        secondCounter   = totalNumOfLines-counter
-
-                        print '1st sensor samples          =', counter
-                        print '2nd sensor samples          =', secondCounter
-
-                        # break data into two sets - for two sensors
-                        firstSensorLines  = lines[:counter] # size = counter
-                        secondSensorLines = lines[counter:] # size = secondCounter
-
-                        if secondCounter < counter:
-                            # subsampling of larger counted sensor data
-                            diff = counter - secondCounter
-                            step = counter / diff
-                            toDelete = np.zeros(diff)
-                            for j in range(diff):
-                                toDelete[j] = int(np.floor(j*step))
-
-                            subsample_lineNum = np.delete(np.arange(counter,dtype=np.int32), toDelete)
-                            subsample_lines=[lines[ind] for ind in subsample_lineNum]
-                            # trimming
-                            if len(subsample_lines) > 2*50*trimLength:
-                                subsample_lines = subsample_lines[50*trimLength:len(subsample_lines)-50*trimLength]
-                                secondSensorLines = secondSensorLines[50*trimLength:len(secondSensorLines)-50*trimLength]
-
-                            # saving
-                            linesToKeep = len(subsample_lines)-(len(subsample_lines)%(50*secondsToKeep))
-                            finalCounterLines=subsample_lines[0:linesToKeep]
-                            finalSecondCounterLines=secondSensorLines[0:linesToKeep]
-
-                        elif secondCounter > counter:
-                            diff = secondCounter - counter
-                            step = secondCounter / diff
-                            toDelete = np.zeros(diff)
-                            for j in range(diff):
-                                toDelete[j] = int(np.floor(j*step))
-
-                            subsample_lineNum = np.delete(np.arange(secondCounter,dtype=np.int32), toDelete)
-                            subsample_lines=[lines[counter+ind] for ind in subsample_lineNum]
-
-                            if len(subsample_lines) > 2*50*trimLength:
-                                firstSensorLines = firstSensorLines[50*trimLength:len(firstSensorLines)-50*trimLength]
-                                subsample_lines = subsample_lines[50*trimLength:len(subsample_lines)-50*trimLength]
-
-                            linesToKeep = len(subsample_lines)-(len(subsample_lines)%(50*secondsToKeep))
-                            finalCounterLines=firstSensorLines[0:linesToKeep]
-                            finalSecondCounterLines=subsample_lines[0:linesToKeep]
-
-                        else:
-                            if len(firstSensorLines) > 2*50*trimLength:
-                                firstSensorLines = firstSensorLines[50*trimLength:len(firstSensorLines)-50*trimLength]
-                                secondSensorLines = secondSensorLines[50*trimLength:len(secondSensorLines)-50*trimLength]
-
-                            linesToKeep = len(secondSensorLines)-(len(secondSensorLines)%(50*secondsToKeep))
-                            finalCounterLines=firstSensorLines[:linesToKeep]
-                            finalSecondCounterLines=secondSensorLines[:linesToKeep]
-
-                        print 'Adjusted 1st sensor samples =', len(finalCounterLines)
-                        print 'Adjusted 2nd sensor samples =', len(finalSecondCounterLines)
-
-                        if firstSensor == "Accelerometer":
-                            for item in finalCounterLines:
-                                outFileAcc.write("%s" % item)
-                            for item in finalSecondCounterLines:
-                                outFileGyro.write("%s" % item)
-                        elif firstSensor == "Gyroscope":
-                            for item in finalSecondCounterLines:
-                                outFileAcc.write("%s" % item)
-                            for item in finalCounterLines:
-                                outFileGyro.write("%s" % item)
-
-        with open(outputFileAcc,'r') as inFileAcc:
-            with open(outputFileGyro,'r') as inFileGyro:
-                with open(finalOutputFile, 'w') as outFile:
-                    lines=inFileAcc.readlines()
-                    for item in lines:
-                        outFile.write("%s" % item)
-                    lines=inFileGyro.readlines()
-                    for item in lines:
-                        outFile.write("%s" % item)
-
-        os.remove(outputFileAcc)
-        os.remove(outputFileGyro)
\ No newline at end of file
+                    with open(finalOutputFiles[k], 'w') as outFile:
+                        for partFileAcc, _ in splitPartFiles:
+                            with open(partFileAcc, 'r') as inFileAcc:
+                                shutil.copyfileobj(inFileAcc, outFile)
+                        for _, partFileGyro in splitPartFiles:
+                            with open(partFileGyro, 'r') as inFileGyro:
+                                shutil.copyfileobj(inFileGyro, outFile)
+
+                    if binaryOutput:
+                        write_binary_output(finalOutputFiles[k], [f[0] for f in splitPartFiles],
+                                            [f[1] for f in splitPartFiles], chunkSize=chunkSize)
+                    else:
+                        remove_binary_output(finalOutputFiles[k])
+
+                    if manifestFile is not None:
+                        write_output_manifest(finalOutputFiles[k], manifestFile, splitPartFiles)
+                continue
+
+            outFilesAcc  = [open(f, 'w') for f in outputFilesAcc]
+            outFilesGyro = [open(f, 'w') for f in outputFilesGyro]
+            try:
+                for i in range(len(file_list)):
+                    # each raw file is processed once and written to every output it belongs to
+                    splits = [k for k in range(len(switchAlgos)) if recording_in_split(file_list[i], switchAlgos[k])]
+                    outFileAcc  = FileTee([outFilesAcc[k] for k in splits])
+                    outFileGyro = FileTee([outFilesGyro[k] for k in splits])
+
+                    preprocess_recording(file_list[i], outFileAcc, outFileGyro, secondsToKeep=secondsToKeep,
+                                         trimLength=trimLength, mode=mode, chunkSize=chunkSize)
+            finally:
+                for outFile in outFilesAcc + outFilesGyro:
+                    outFile.close()
+
+            for k in range(len(finalOutputFiles)):
+                with open(outputFilesAcc[k],'r') as inFileAcc:
+                    with open(outputFilesGyro[k],'r') as inFileGyro:
+                        with open(finalOutputFiles[k], 'w') as outFile:
+                            shutil.copyfileobj(inFileAcc, outFile)
+                            shutil.copyfileobj(inFileGyro, outFile)
+
+                if binaryOutput:
+                    write_binary_output(finalOutputFiles[k], [outputFilesAcc[k]], [outputFilesGyro[k]],
+                                        chunkSize=chunkSize)
+                else:
+                    remove_binary_output(finalOutputFiles[k])
+
+                os.remove(outputFilesAcc[k])
+                os.remove(outputFilesGyro[k])
+
+        if cacheDir is not None and cacheMaxBytes is not None:
+            evict_cache(cacheDir, cacheMaxBytes, partFiles.values())
+    finally:
+        if tempDir is not None:
+            shutil.rmtree(tempDir)
+
+
+def recording_in_split(fileName, switchAlgo=0):
+    """
+    Checks whether a raw data file is used in the given testing scenario, based on the tags in its name.
+    :param fileName: path of the raw data file
+    :param switchAlgo: testing scenario (see data_preprocessing)
+    :return: True if the file is used, False otherwise
+    """
+    # avoiding files with 'Final' in its name
+    if 'Final' in fileName:
+        return False
+
+    if switchAlgo==0:
+        # avoiding files with 'newPerson' or 'singleTest' in its name
+        if 'newPerson' in fileName or 'singleTest' in fileName:
+            return False
+    elif switchAlgo==2:
+        # taking only files with 'newPerson' or 'singleTest' in its name
+        if 'newPerson' not in fileName and 'singleTest' not in fileName:
+            return False
+    elif switchAlgo==3:
+        # taking only files with 'singleTest' in its name
+        if 'singleTest' not in fileName:
+            return False
+    elif switchAlgo==4:
+        # avoid files 'singleTest' in its name
+        if 'singleTest' in fileName:
+            return False
+
+    return True
+
+
+def preprocess_recording(fileName, outFileAcc, outFileGyro, secondsToKeep=30, trimLength=15, mode='lines',
+                         chunkSize=100000):
+    """
+    Pre-processes a single raw data file and appends its accelerometer and gyroscope samples to the given streams.
+    :param fileName: path of the raw data file
+    :param outFileAcc: open file to which the accelerometer samples are written
+    :param outFileGyro: open file to which the gyroscope samples are written
+    :param secondsToKeep: Number of seconds to keep in each sample
+    :param trimLength: Number of seconds to trim at the start and enf of a raw data file
+    :param mode: 'lines', 'arrays' or 'stream' (see data_preprocessing)
+    :param chunkSize: Number of lines read at a time in 'stream' mode
+    :return: Nothing
+    """
+    if mode == 'stream':
+        preprocess_recording_stream(fileName, outFileAcc, outFileGyro, secondsToKeep=secondsToKeep,
+                                    trimLength=trimLength, chunkSize=chunkSize)
+    elif mode == 'arrays':
+        preprocess_recording_arrays(fileName, outFileAcc, outFileGyro, secondsToKeep=secondsToKeep,
+                                    trimLength=trimLength)
+    elif mode == 'lines':
+        preprocess_recording_lines(fileName, outFileAcc, outFileGyro, secondsToKeep=secondsToKeep,
+                                   trimLength=trimLength)
+    else:
+        raise ValueError('Unknown preprocessing mode: ' + str(mode))
+
+
+def write_binary_output(finalOutputFile, textFilesAcc, textFilesGyro, chunkSize=100000):
+    """
+    Writes the binary version of an output file: the sensor values of each sensor as a float32 .npy array of shape
+    (samples, 3), and a small .json header with the sensor order, the block lengths and the array files.
+    :param finalOutputFile: path of the (text) output file
+    :param textFilesAcc: text files holding the accelerometer lines of the output, in order
+    :param textFilesGyro: text files holding the gyroscope lines of the output, in order
+    :param chunkSize: Number of lines converted at a time
+    :return: Nothing
+    """
+    headerFile = finalOutputFile[:-4] + '.json'
+    header = {'sensors': ['Accelerometer', 'Gyroscope'],
+              'files':   [os.path.basename(finalOutputFile[:-4]) + '_Acc.npy',
+                          os.path.basename(finalOutputFile[:-4]) + '_Gyro.npy'],
+              'lengths': [],
+              'dtype':   'float32'}
+
+    for textFiles, arrayFile in zip([textFilesAcc, textFilesGyro], header['files']):
+        numLines = 0
+        for textFile in textFiles:
+            with open(textFile, 'r') as fileStream:
+                numLines += sum(1 for _ in fileStream)
+
+        header['lengths'].append(numLines)
+        if numLines == 0:
+            np.save(os.path.join(os.path.dirname(finalOutputFile), arrayFile), np.zeros((0, 3), dtype=np.float32))
+            continue
+
+        sensorData = np.lib.format.open_memmap(os.path.join(os.path.dirname(finalOutputFile), arrayFile),
+                                               mode='w+', dtype=np.float32, shape=(numLines, 3))
+        lineNum = 0
+        for textFile in textFiles:
+            with open(textFile, 'r') as fileStream:
+                while True:
+                    lines = list(itertools.islice(fileStream, chunkSize))
+                    if len(lines) == 0:
+                        break
+                    sensorData[lineNum:lineNum+len(lines)] = \
+                        np.array([line.split(', ')[2:5] for line in lines]).astype(np.float32)
+                    lineNum += len(lines)
+        sensorData.flush()
+        del sensorData
+
+    with open(headerFile, 'w') as fileStream:
+        json.dump(header, fileStream)
+
+
+def remove_binary_output(finalOutputFile):
+    """
+    Removes the binary version of an output file, if any, so that it never goes out of sync with the text version.
+    :param finalOutputFile: path of the (text) output file
+    :return: Nothing
+    """
+    headerFile = finalOutputFile[:-4] + '.json'
+    if not os.path.exists(headerFile):
+        return
+    with open(headerFile, 'r') as fileStream:
+        header = json.load(fileStream)
+    os.remove(headerFile)
+    for arrayFile in header['files']:
+        arrayFile = os.path.join(os.path.dirname(finalOutputFile), arrayFile)
+        if os.path.exists(arrayFile):
+            os.remove(arrayFile)
+
+
+def recording_fingerprint(fileName, secondsToKeep=30, trimLength=15, fingerprint='stat'):
+    """
+    Cache key of the pre-processed samples of a raw data file.
+    :param fileName: path of the raw data file
+    :param secondsToKeep: Number of seconds to keep in each sample
+    :param trimLength: Number of seconds to trim at the start and enf of a raw data file
+    :param fingerprint: 'stat' or 'content' (see data_preprocessing)
+    :return: hex digest identifying the raw file and the pre-processing parameters
+    """
+    digest = hashlib.sha1()
+    if fingerprint == 'content':
+        with open(fileName, 'rb') as fileStream:
+            for block in iter(lambda: fileStream.read(1 << 20), ''):
+                digest.update(block)
+    elif fingerprint == 'stat':
+        stat = os.stat(fileName)
+        digest.update('%s:%d:%r' % (os.path.abspath(fileName), stat.st_size, stat.st_mtime))
+    else:
+        raise ValueError('Unknown cache fingerprint: ' + str(fingerprint))
+    digest.update(':%d:%d' % (secondsToKeep, trimLength))
+    return digest.hexdigest()
+
+
+def evict_cache(cacheDir, maxBytes, usedPartFiles):
+    """
+    Removes the pre-processed samples of the least recently used raw files from the cache (see data_preprocessing)
+    until it holds at most maxBytes, or only the samples in use are left.
+    :param cacheDir: directory of the cache
+    :param maxBytes: size cap of the cache in bytes
+    :param usedPartFiles: list of (accelerometer file, gyroscope file) pairs that are in use, which are kept
+    :return: Nothing
+    """
+    used = set(os.path.abspath(pair[0]) for pair in usedPartFiles)
+    entries = []
+    for partFileAcc in glob.glob(os.path.join(cacheDir, '*_Acc.csv')):
+        partFileGyro = partFileAcc[:-len('_Acc.csv')] + '_Gyro.csv'
+        size = os.path.getsize(partFileAcc)
+        if os.path.exists(partFileGyro):
+            size += os.path.getsize(partFileGyro)
+        entries.append((os.path.getmtime(partFileAcc), partFileAcc, partFileGyro, size))
+
+    totalSize = sum(entry[3] for entry in entries)
+    for lastUsed, partFileAcc, partFileGyro, size in sorted(entries):
+        if totalSize <= maxBytes:
+            break
+        if os.path.abspath(partFileAcc) not in used:
+            os.remove(partFileAcc)
+            if os.path.exists(partFileGyro):
+                os.remove(partFileGyro)
+            totalSize -= size
+
+
+def output_up_to_date(finalOutputFile, manifestFile, partFiles):
+    """
+    Checks whether an output file was merged from the given cached files and has not been touched since.
+    :param finalOutputFile: path of the output file
+    :param manifestFile: path of the manifest written along with the output file
+    :param partFiles: list of (accelerometer file, gyroscope file) pairs the output should be merged from
+    :return: True if the output file does not need to be merged again
+    """
+    if not os.path.exists(finalOutputFile) or not os.path.exists(manifestFile):
+        return False
+    with open(manifestFile, 'r') as fileStream:
+        manifest = json.load(fileStream)
+    stat = os.stat(finalOutputFile)
+    return manifest['parts'] == [[os.path.basename(f) for f in pair] for pair in partFiles] \
+        and manifest['size'] == stat.st_size and manifest['mtime'] == stat.st_mtime
+
+
+def write_output_manifest(finalOutputFile, manifestFile, partFiles):
+    """
+    Records which cached files an output file was merged from (see output_up_to_date).
+    Parameters are the same as for output_up_to_date.
+    :return: Nothing
+    """
+    stat = os.stat(finalOutputFile)
+    with open(manifestFile, 'w') as fileStream:
+        json.dump({'parts': [[os.path.basename(f) for f in pair] for pair in partFiles],
+                   'size': stat.st_size, 'mtime': stat.st_mtime}, fileStream)
+
+
+def preprocess_recording_to_files(args):
+    """
+    Worker function for the parallel and cached modes of data_preprocessing.
+    Pre-processes a single raw data file into its own accelerometer and gyroscope output files.
+    The files are only put in place once they are complete, so an interrupted run never leaves partial files.
+    :param args: tuple of (fileName, outputFileAcc, outputFileGyro, secondsToKeep, trimLength, mode, chunkSize)
+    :return: the messages printed while pre-processing the file
+    """
+    fileName, outputFileAcc, outputFileGyro, secondsToKeep, trimLength, mode, chunkSize = args
+    stdout = sys.stdout
+    sys.stdout = messages = cStringIO.StringIO()
+    try:
+        with open(outputFileAcc + '.tmp', 'w') as outFileAcc:
+            with open(outputFileGyro + '.tmp', 'w') as outFileGyro:
+                preprocess_recording(fileName, outFileAcc, outFileGyro, secondsToKeep=secondsToKeep,
+                                     trimLength=trimLength, mode=mode, chunkSize=chunkSize)
+    finally:
+        sys.stdout = stdout
+    os.rename(outputFileAcc + '.tmp', outputFileAcc)
+    os.rename(outputFileGyro + '.tmp', outputFileGyro)
+    return messages.getvalue()
+
+
+def preprocess_recording_lines(fileName, outFileAcc, outFileGyro, secondsToKeep=30, trimLength=15):
+    """
+    Pre-processes a single raw data file handled as a list of text lines.
+    Parameters are the same as for preprocess_recording.
+    """
+    with open(fileName, 'r') as fileStream:
+        counter=1
+        firstSensor  = "Accelerometer"
+        secondSensor = "Gyroscope"
+
+        print '\nFile:', fileName
+
+        firstLine=fileStream.readline()
+        firstWord=firstLine.split(', ')[0]
+
+        if "gyro" in firstWord.lower():
+            firstSensor = "Gyroscope"
+
+        while True:
+            line=fileStream.readline()
+            currFirstWord=line.split(', ')[0]
+            if firstWord==currFirstWord:
+                counter+=1
+            else:
+                break
+
+        line=fileStream.readline()
+        firstWord=line.split(', ')[0]
+
+        if "accel" in firstWord.lower():
+            secondSensor = "Accelerometer"
+
+        fileStream.seek(0)
+        lines           = fileStream.readlines()
+        totalNumOfLines = len(lines)
+        secondCounter   = totalNumOfLines-counter
+
+        print '1st sensor samples          =', counter
+        print '2nd sensor samples          =', secondCounter
+
+        # break data into two sets - for two sensors
+        firstSensorLines  = lines[:counter] # size = counter
+        secondSensorLines = lines[counter:] # size = secondCounter
+
+        if secondCounter < counter:
+            # subsampling of larger counted sensor data
+            diff = counter - secondCounter
+            step = counter / diff
+            toDelete = np.zeros(diff)
+            for j in range(diff):
+                toDelete[j] = int(np.floor(j*step))
+
+            subsample_lineNum = np.delete(np.arange(counter,dtype=np.int32), toDelete)
+            subsample_lines=[lines[ind] for ind in subsample_lineNum]
+            # trimming
+            if len(subsample_lines) > 2*50*trimLength:
+                subsample_lines = subsample_lines[50*trimLength:len(subsample_lines)-50*trimLength]
+                secondSensorLines = secondSensorLines[50*trimLength:len(secondSensorLines)-50*trimLength]
+
+            # saving
+            linesToKeep = len(subsample_lines)-(len(subsample_lines)%(50*secondsToKeep))
+            finalCounterLines=subsample_lines[0:linesToKeep]
+            finalSecondCounterLines=secondSensorLines[0:linesToKeep]
+
+        elif secondCounter > counter:
+            diff = secondCounter - counter
+            step = secondCounter / diff
+            toDelete = np.zeros(diff)
+            for j in range(diff):
+                toDelete[j] = int(np.floor(j*step))
+
+            subsample_lineNum = np.delete(np.arange(secondCounter,dtype=np.int32), toDelete)
+            subsample_lines=[lines[counter+ind] for ind in subsample_lineNum]
+
+            if len(subsample_lines) > 2*50*trimLength:
+                firstSensorLines = firstSensorLines[50*trimLength:len(firstSensorLines)-50*trimLength]
+                subsample_lines = subsample_lines[50*trimLength:len(subsample_lines)-50*trimLength]
+
+            linesToKeep = len(subsample_lines)-(len(subsample_lines)%(50*secondsToKeep))
+            finalCounterLines=firstSensorLines[0:linesToKeep]
+            finalSecondCounterLines=subsample_lines[0:linesToKeep]
+
+        else:
+            if len(firstSensorLines) > 2*50*trimLength:
+                firstSensorLines = firstSensorLines[50*trimLength:len(firstSensorLines)-50*trimLength]
+                secondSensorLines = secondSensorLines[50*trimLength:len(secondSensorLines)-50*trimLength]
+
+            linesToKeep = len(secondSensorLines)-(len(secondSensorLines)%(50*secondsToKeep))
+            finalCounterLines=firstSensorLines[:linesToKeep]
+            finalSecondCounterLines=secondSensorLines[:linesToKeep]
+
+        print 'Adjusted 1st sensor samples =', len(finalCounterLines)
+        print 'Adjusted 2nd sensor samples =', len(finalSecondCounterLines)
+
+        if firstSensor == "Accelerometer":
+            for item in finalCounterLines:
+                outFileAcc.write("%s" % item)
+            for item in finalSecondCounterLines:
+                outFileGyro.write("%s" % item)
+        elif firstSensor == "Gyroscope":
+            for item in finalSecondCounterLines:
+                outFileAcc.write("%s" % item)
+            for item in finalCounterLines:
+                outFileGyro.write("%s" % item)
+
+
+def preprocess_recording_arrays(fileName, outFileAcc, outFileGyro, secondsToKeep=30, trimLength=15):
+    """
+    Pre-processes a single raw data file loaded once into a NumPy array of lines.
+    Both sensor streams are aligned, trimmed and cut into samples as index arrays, and each of them is written out
+    with a single call. The lines are kept as they are, so the output is identical to preprocess_recording_lines.
+    Parameters are the same as for preprocess_recording.
+    """
+    print '\nFile:', fileName
+
+    with open(fileName, 'r') as fileStream:
+        lines = np.array(fileStream.readlines())
+
+    firstSensor = "Accelerometer"
+    firstWord = lines[0].split(', ')[0] if lines.size > 0 else ''
+    if "gyro" in firstWord.lower():
+        firstSensor = "Gyroscope"
+
+    # the first sensor block ends at the first line starting with a different word
+    isFirstSensor = lines_start_with(lines, firstWord + ', ')
+    isFirstSensor[:1] = True
+    counter = lines.size if np.all(isFirstSensor) else int(np.argmin(isFirstSensor))
+    secondCounter = lines.size - counter
+
+    print '1st sensor samples          =', counter
+    print '2nd sensor samples          =', secondCounter
+
+    firstSensorIndices  = np.arange(counter)
+    secondSensorIndices = counter + np.arange(secondCounter)
+
+    # subsampling of larger counted sensor data
+    if secondCounter < counter:
+        firstSensorIndices = subsample_indices(counter, secondCounter)
+    elif secondCounter > counter:
+        secondSensorIndices = counter + subsample_indices(secondCounter, counter)
+
+    # trimming
+    numLines = firstSensorIndices.size
+    if numLines > 2*50*trimLength:
+        firstSensorIndices  = firstSensorIndices[50*trimLength:numLines-50*trimLength]
+        secondSensorIndices = secondSensorIndices[50*trimLength:numLines-50*trimLength]
+
+    # saving
+    linesToKeep = firstSensorIndices.size - (firstSensorIndices.size % (50*secondsToKeep))
+    finalCounterLines       = lines[firstSensorIndices[:linesToKeep]]
+    finalSecondCounterLines = lines[secondSensorIndices[:linesToKeep]]
+
+    print 'Adjusted 1st sensor samples =', finalCounterLines.size
+    print 'Adjusted 2nd sensor samples =', finalSecondCounterLines.size
+
+    if firstSensor == "Accelerometer":
+        outFileAcc.write(''.join(finalCounterLines))
+        outFileGyro.write(''.join(finalSecondCounterLines))
+    elif firstSensor == "Gyroscope":
+        outFileAcc.write(''.join(finalSecondCounterLines))
+        outFileGyro.write(''.join(finalCounterLines))
+
+
+def preprocess_recording_stream(fileName, outFileAcc, outFileGyro, secondsToKeep=30, trimLength=15, chunkSize=100000):
+    """
+    Pre-processes a single raw data file in chunks of chunkSize lines, so that memory use does not depend on the
+    length of the recording. The file is read twice: once to find the sensor block boundary and the block sizes,
+    and once to subsample, trim and write the samples chunk by chunk. The output is identical to
+    preprocess_recording_lines.
+    Parameters are the same as for preprocess_recording.
+    """
+    print '\nFile:', fileName
+
+    firstSensor = "Accelerometer"
+    firstWord = None
+    counter = None
+    totalNumOfLines = 0
+
+    # first pass: find where the first sensor block ends and count the lines
+    with open(fileName, 'r') as fileStream:
+        while True:
+            lines = np.array(list(itertools.islice(fileStream, chunkSize)))
+            if lines.size == 0:
+                break
+            if firstWord is None:
+                firstWord = lines[0].split(', ')[0]
+                if "gyro" in firstWord.lower():
+                    firstSensor = "Gyroscope"
+            if counter is None:
+                isFirstSensor = lines_start_with(lines, firstWord + ', ')
+                if totalNumOfLines == 0:
+                    isFirstSensor[0] = True
+                if not np.all(isFirstSensor):
+                    counter = totalNumOfLines + int(np.argmin(isFirstSensor))
+            totalNumOfLines += lines.size
+
+    if counter is None:
+        counter = totalNumOfLines
+    secondCounter = totalNumOfLines - counter
+
+    print '1st sensor samples          =', counter
+    print '2nd sensor samples          =', secondCounter
+
+    # sizes after subsampling, trimming and cutting into samples
+    numLines = min(counter, secondCounter)
+    startLine = 0
+    if numLines > 2*50*trimLength:
+        startLine = 50*trimLength
+        numLines  = numLines - 2*50*trimLength
+    linesToKeep = numLines - (numLines % (50*secondsToKeep))
+
+    print 'Adjusted 1st sensor samples =', linesToKeep
+    print 'Adjusted 2nd sensor samples =', linesToKeep
+
+    if firstSensor == "Accelerometer":
+        outFileFirst, outFileSecond = outFileAcc, outFileGyro
+    else:
+        outFileFirst, outFileSecond = outFileGyro, outFileAcc
+
+    # second pass: write the kept lines of each chunk
+    with open(fileName, 'r') as fileStream:
+        lineNum = 0
+        while True:
+            lines = np.array(list(itertools.islice(fileStream, chunkSize)))
+            if lines.size == 0:
+                break
+            lineNums = lineNum + np.arange(lines.size)
+            lineNum += lines.size
+
+            isFirstSensor = lineNums < counter
+            positions = np.zeros(lines.size, dtype=int)
+            positions[isFirstSensor] = subsampled_positions(lineNums[isFirstSensor], counter, secondCounter)
+            positions[~isFirstSensor] = subsampled_positions(lineNums[~isFirstSensor] - counter, secondCounter, counter)
+            keep = (positions >= startLine) & (positions < startLine + linesToKeep)
+
+            outFileFirst.write(''.join(lines[keep & isFirstSensor]))
+            outFileSecond.write(''.join(lines[keep & ~isFirstSensor]))
+
+
+def lines_start_with(lines, prefix):
+    """
+    Vectorized check of which lines start with the given prefix (compares the raw bytes of the lines).
+    :param lines: NumPy array of lines (fixed-width strings)
+    :param prefix: prefix to look for
+    :return: boolean array, True for the lines starting with prefix
+    """
+    if len(prefix) > lines.dtype.itemsize:
+        return np.zeros(lines.size, dtype=bool)
+    chars = lines.view(np.uint8).reshape((lines.size, lines.dtype.itemsize))[:, :len(prefix)]
+    return np.all(chars == np.frombuffer(prefix, dtype=np.uint8), axis=1)
+
+
+def subsample_indices(largerCount, smallerCount):
+    """
+    Evenly drops samples from the larger sensor stream so that it matches the size of the smaller one.
+    :param largerCount: number of samples in the larger stream
+    :param smallerCount: number of samples in the smaller stream
+    :return: indices of the samples to keep from the larger stream
+    """
+    diff = largerCount - smallerCount
+    step = largerCount / diff
+    keep = np.ones(largerCount, dtype=bool)
+    keep[np.arange(diff) * step] = False
+    return np.flatnonzero(keep)
+
+
+def subsampled_positions(indices, largerCount, smallerCount):
+    """
+    Positions that the given samples of a stream take after it is subsampled as in subsample_indices.
+    Streams that are not larger than the other one are left as they are.
+    :param indices: indices of samples in the stream
+    :param largerCount: number of samples in the stream
+    :param smallerCount: number of samples in the other stream
+    :return: positions of the samples in the subsampled stream, -1 for dropped samples
+    """
+    if largerCount <= smallerCount:
+        return indices
+    diff = largerCount - smallerCount
+    step = largerCount / diff
+    positions = indices - np.minimum(diff, indices / step + 1)
+    positions[(indices % step == 0) & (indices / step < diff)] = -1
+    return positions
+
+
+class FileTee(object):
+    """
+    File-like object that writes everything to several open files at once.
+    """
+    def __init__(self, files):
+        """
+        Initialization.
+        :param files: list of open files to write to
+        """
+        self.files = files
+
+    def write(self, data):
+        """
+        Writes data to all the files.
+        :param data: string to write
+        :return: Nothing
+        """
+        for outFile in self.files:
+            outFile.write(data)
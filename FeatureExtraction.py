@@ -2,8 +2,9 @@ import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import numpy as np
-import scipy.fftpack
 import FeatureExtractionHelperFunctions as fehp
+import json
+import multiprocessing
 import os
 
 
@@ -11,7 +12,13 @@ def feature_extraction(sports=['Badminton','Basketball','Foosball','Running','Sk
                        numSecondsPerImage=30,
                        fftWidth=6,
                        fftJump=2,
-                       finalOrNew=0):
+                       finalOrNew=0,
+                       binaryInput=False,
+                       featureStore=None,
+                       numWorkers=1,
+                       outputFormat='csv',
+                       featureDtype=np.float64,
+                       workerPool=None):
     """
     Extracts features for the samples which are meant to be fed to a classifier later.
     Final features are:
@@ -35,35 +42,210 @@ def feature_extraction(sports=['Badminton','Basketball','Foosball','Running','Sk
     :param fftWidth:
     :param fftJump:
     :param finalOrNew: 0 for Final, 1 for newPerson
-    :return: Nothing
+    :param binaryInput: Set True to memory-map the binary version of the Final files written by
+                        DataPreprocessing.data_preprocessing(binaryOutput=True) instead of parsing the text version
+    :param featureStore: FeatureStore.FeatureStore to fetch the features from if they were already extracted from the
+                         same input, and to save them to otherwise (None to always extract and save to ../Data).
+                         The stored files stay pinned in the store until they are passed to its release method.
+    :param numWorkers: Number of worker processes that extract the features of blocks of samples in parallel
+                       (1 for serial). With binaryInput, workers memory-map the input themselves.
+    :param outputFormat: 'csv' to save the features as text, or 'npy' to save them as binary .npy arrays that
+                         are written in place sport by sport (labels are saved as int8)
+    :param featureDtype: dtype the features are saved with (e.g. np.float32 to halve the size of the npy output)
+    :param workerPool: multiprocessing.Pool of numWorkers processes to extract with, instead of one that is created
+                       and closed in every call (it is left open). The workers are forked, so a pool created before
+                       any tensorflow session exists keeps them free of tensorflow state.
+    :return: paths of the features, secondary features and labels files
     """
-
-    numColumns = (numSecondsPerImage - fftWidth) / fftJump + 1  # total no of columns to include in one image
-
-    outputLabels = None
-    outputArray  = None
-    outputSecondaryArray = None
+    return feature_extraction_multi(sports=sports, numSecondsPerImage=numSecondsPerImage,
+                                    configs=[(fftWidth, fftJump)], finalOrNew=finalOrNew, binaryInput=binaryInput,
+                                    fileSuffixes=[''], featureStore=featureStore, numWorkers=numWorkers,
+                                    outputFormat=outputFormat, featureDtype=featureDtype,
+                                    workerPool=workerPool)[(fftWidth, fftJump)]
+
+
+def feature_extraction_multi(sports=['Badminton','Basketball','Foosball','Running','Skating','Walking'],
+                             numSecondsPerImage=30,
+                             configs=[(6, 2)],
+                             finalOrNew=0,
+                             binaryInput=False,
+                             fileSuffixes=None,
+                             featureStore=None,
+                             numWorkers=1,
+                             outputFormat='csv',
+                             featureDtype=np.float64,
+                             workerPool=None):
+    """
+    Extracts features (see feature_extraction) for several FFT configurations at once. The data of each sport is
+    loaded only once and shared by all configurations.
+    :param sports:
+    :param numSecondsPerImage:
+    :param configs: list of (fftWidth, fftJump) configurations
+    :param finalOrNew: 0 for Final, 1 for newPerson
+    :param binaryInput: see feature_extraction
+    :param fileSuffixes: suffixes added to the output file names of each configuration
+                         (defaults to '_<numSecondsPerImage>s_<fftWidth>w_<fftJump>j')
+    :param featureStore: see feature_extraction. Only the configurations missing from the store are extracted.
+    :param numWorkers: see feature_extraction
+    :param outputFormat: see feature_extraction
+    :param featureDtype: see feature_extraction
+    :param workerPool: see feature_extraction
+    :return: dict from (fftWidth, fftJump) to the paths of the features, secondary features and labels files
+    """
+    if fileSuffixes is None:
+        fileSuffixes = ['_%ds_%dw_%dj' % (numSecondsPerImage, fftWidth, fftJump) for fftWidth, fftJump in configs]
+
+    outputFiles = {}
+    if featureStore is not None:
+        inputDigest = featureStore.input_digest(input_files(sports, finalOrNew=finalOrNew, binaryInput=binaryInput))
+        storeKeys = {}
+        for fftWidth, fftJump in configs:
+            storeKeys[(fftWidth, fftJump)] = featureStore.key(inputDigest, sports=sports,
+                                                              numSecondsPerImage=numSecondsPerImage,
+                                                              fftWidth=fftWidth, fftJump=fftJump,
+                                                              finalOrNew=finalOrNew, binaryInput=binaryInput,
+                                                              outputFormat=outputFormat,
+                                                              featureDtype=np.dtype(featureDtype).name)
+            storedFiles = featureStore.get(storeKeys[(fftWidth, fftJump)])
+            if storedFiles is not None:
+                print 'Found features for fftWidth =', fftWidth, ' fftJump =', fftJump, 'in the feature store'
+                outputFiles[(fftWidth, fftJump)] = tuple(storedFiles)
+
+        fileSuffixes = [fileSuffixes[c] for c in range(len(configs)) if configs[c] not in outputFiles]
+        configs = [config for config in configs if config not in outputFiles]
+        if len(configs) == 0:
+            return outputFiles
+
+    # samples are counted up front, so that the features of each sport can be written straight into place
+    numSamples = sum(count_samples(final_file(sport, finalOrNew=finalOrNew), numSecondsPerImage=numSecondsPerImage,
+                                   binaryInput=binaryInput) for sport in sports)
+    writers = []
+    for c in range(len(configs)):
+        numFeatures, numSecondaryFeatures = num_features(numSecondsPerImage=numSecondsPerImage,
+                                                         fftWidth=configs[c][0], fftJump=configs[c][1])
+        writers.append(FeatureWriter(numSamples, numFeatures, numSecondaryFeatures, len(sports),
+                                     finalOrNew=finalOrNew, fileSuffix=fileSuffixes[c], outputFormat=outputFormat,
+                                     featureDtype=featureDtype))
+
+    pool = None
+    if numWorkers > 1:
+        pool = workerPool if workerPool is not None else multiprocessing.Pool(numWorkers)
 
     for ind in range(len(sports)):
         print '\n'+sports[ind]
 
-        fileName = '../Data/' + sports[ind] + '/Final.csv'
-        if finalOrNew == 1:
-            fileName = '../Data/' + sports[ind] + '/newPersonFinal.csv'
+        fileName = final_file(sports[ind], finalOrNew=finalOrNew)
+        sensorData = load_sensor_data(fileName, binaryInput=binaryInput)
+        if sensorData is None:
+            continue
+        firstSensor, firstSensorData, secondSensorData = sensorData
+
+        if pool is None:
+            firstSensorData = np.asarray(firstSensorData, dtype=float)
+            secondSensorData = np.asarray(secondSensorData, dtype=float)
+        else:
+            # blocks of samples are extracted in parallel and their matrices merged back in sample order
+            sportSamples = firstSensorData.shape[0] / (50 * numSecondsPerImage)
+            blocks = feature_blocks(firstSensor, fileName, firstSensorData, secondSensorData, numSecondsPerImage,
+                                    configs, binaryInput=binaryInput,
+                                    blockSize=max(1, sportSamples / (numWorkers * 4)))
+            try:
+                blockMatrices = pool.map(extract_features_block, blocks, chunksize=1)
+            except:
+                pool.terminate()
+                pool.join()
+                raise
+            matrices = [[np.concatenate([m[c][k] for m in blockMatrices], axis=-1) for k in range(3)]
+                        for c in range(len(configs))]
+
+        for c in range(len(configs)):
+            fftWidth, fftJump = configs[c]
+            if len(configs) > 1:
+                print '\nfftWidth =', fftWidth, ' fftJump =', fftJump
+
+            if pool is None:
+                outputIntermediateArray, secondaryIntermediateArray = \
+                    extract_features(firstSensor, firstSensorData, secondSensorData,
+                                     numSecondsPerImage=numSecondsPerImage, fftWidth=fftWidth, fftJump=fftJump)
+            else:
+                outputIntermediateArray, secondaryIntermediateArray = flatten_features(*matrices[c])
+
+            intermediateOutputLabels = np.zeros((outputIntermediateArray.shape[0], len(sports)))
+            intermediateOutputLabels[:, ind] = 1
+            print 'intermediateOutputLabels.shape for', sports[ind], ': ', intermediateOutputLabels.shape
+
+            writers[c].write(outputIntermediateArray, secondaryIntermediateArray, intermediateOutputLabels)
+
+    if pool is not None and workerPool is None:
+        pool.close()
+        pool.join()
+
+    for c in range(len(configs)):
+        print '\noutputArray.shape: ', writers[c].shapes[0]
+        print 'outputSecondaryArray.shape: ', writers[c].shapes[1]
+        print 'outputLabels.shape: ', writers[c].shapes[2]
+
+        outputFiles[configs[c]] = writers[c].close()
+        if featureStore is not None:
+            outputFiles[configs[c]] = tuple(featureStore.put(storeKeys[configs[c]], outputFiles[configs[c]]))
+
+    return outputFiles
+
+
+def final_file(sport, finalOrNew=0):
+    """
+    :param sport: name of the activity
+    :param finalOrNew: 0 for Final, 1 for newPerson
+    :return: path of the pre-processed data file of the activity
+    """
+    if finalOrNew == 1:
+        return '../Data/' + sport + '/newPersonFinal.csv'
+    return '../Data/' + sport + '/Final.csv'
+
+
+def input_files(sports, finalOrNew=0, binaryInput=False):
+    """
+    :param sports: names of the activities
+    :param finalOrNew: 0 for Final, 1 for newPerson
+    :param binaryInput: see feature_extraction
+    :return: paths of all the files feature extraction reads its input from
+    """
+    fileNames = []
+    for sport in sports:
+        fileName = final_file(sport, finalOrNew=finalOrNew)
+        if binaryInput:
+            fileNames.extend([fileName[:-4] + '.json', fileName[:-4] + '_Acc.npy', fileName[:-4] + '_Gyro.npy'])
+        else:
+            fileNames.append(fileName)
+    return fileNames
+
 
+def load_sensor_data(fileName, binaryInput=False):
+    """
+    Loads the sensor values of a Final file.
+    :param fileName: path of the Final file
+    :param binaryInput: see feature_extraction
+    :return: name of the first sensor in the file, and (rows x 3) arrays of the first and second sensors
+             (float64 arrays for text input, float32 memory maps for binary input; None if there is nothing to load)
+    """
+    if binaryInput:
+        firstSensor, secondSensor, firstSensorData, secondSensorData = fehp.load_binary_sensor_data(fileName)
+        if firstSensorData is None:
+            print 'Nothing to load'
+            return None
+        return firstSensor, firstSensorData, secondSensorData
+    else:
         if os.path.exists(fileName) and os.path.getsize(fileName) > 0:
             pass
         else:
             print 'Nothing to load'
-            continue
+            return None
 
         data = np.loadtxt(fileName, dtype='string', delimiter=', ')
         counter = 1
         firstSensor = "Accelerometer"
         secondSensor = "Gyroscope"
 
-        totalNumOfLines = fehp.file_len(fileName)
-
         with open(fileName, 'r') as fileStream:
             firstLine = fileStream.readline()
             firstWord = firstLine.split(', ')[0]
@@ -85,207 +267,306 @@ def feature_extraction(sports=['Badminton','Basketball','Foosball','Running','Sk
             if "accel" in firstWord.lower():
                 secondSensor = "Accelerometer"
 
-        ## USED FOR PLOTTING
-        # firstSensor_unFormattedTime = data[0:counter, 1]
-        # firstSensor_Time = np.arange(firstSensor_unFormattedTime.shape[0]) / 50.0
-
-        # secondSensor_unFormattedTime = data[counter:, 1]
-        # secondSensor_Time = np.arange(secondSensor_unFormattedTime.shape[0]) / 50.0
-
-        # firstSensor_1 = data[:counter, 2]
-        # firstSensor_2 = data[:counter, 3]
-        # firstSensor_3 = data[:counter, 4]
-        # secondSensor_1 = data[counter:, 2]
-        # secondSensor_2 = data[counter:, 3]
-        # secondSensor_3 = data[counter:, 4]
-
-        # firstNtoIgnore = 20
-
-        # fft_firstSensor1 = scipy.fftpack.fft(firstSensor_1)
-        # fft_firstSensor1[0:firstNtoIgnore] = 0
-        # fft_firstSensor2 = scipy.fftpack.fft(firstSensor_2)
-        # fft_firstSensor2[0:firstNtoIgnore] = 0
-        # fft_firstSensor3 = scipy.fftpack.fft(firstSensor_3)
-        # fft_firstSensor3[0:firstNtoIgnore] = 0
-        # fft_secondSensor1 = scipy.fftpack.fft(secondSensor_1)
-        # fft_secondSensor1[0:firstNtoIgnore] = 0
-        # fft_secondSensor2 = scipy.fftpack.fft(secondSensor_2)
-        # fft_secondSensor2[0:firstNtoIgnore] = 0
-        # fft_secondSensor3 = scipy.fftpack.fft(secondSensor_3)
-        # fft_secondSensor3[0:firstNtoIgnore] = 0
-        #
-        # x_firstSensor1 = np.linspace(0, 25, fft_firstSensor1.size / 2)
-        # x_firstSensor2 = np.linspace(0, 25, fft_firstSensor2.size / 2)
-        # x_firstSensor3 = np.linspace(0, 25, fft_firstSensor3.size / 2)
-        # x_secondSensor1 = np.linspace(0, 25, fft_secondSensor1.size / 2)
-        # x_secondSensor2 = np.linspace(0, 25, fft_secondSensor2.size / 2)
-        # x_secondSensor3 = np.linspace(0, 25, fft_secondSensor3.size / 2)
-
-        # 6 is the number of sensors, finalMatrix corresponds to FFT features, secondaryMatrix corresponds to statistical
-        finalMatrix = np.zeros((((50 * fftWidth) / 2), numColumns, 6, totalNumOfLines / (50 * 2 * numSecondsPerImage)))
-        secondaryMatrix = np.zeros((16, numColumns, 6, totalNumOfLines / (50 * 2 * numSecondsPerImage)))
-
-        for n in range(finalMatrix.shape[3]):
-            for j in range(finalMatrix.shape[1]):
-                for k in range(3):
-                    currFirstSensor = data[(n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                        (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)), k + 2]
-                    currFirstSensor = currFirstSensor.astype(float)
-                    curr_fft_firstSensor = scipy.fftpack.fft(currFirstSensor)
-                    currSecondSensor = data[counter + (n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                        counter + (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)), k + 2]
-                    currSecondSensor = currSecondSensor.astype(float)
-                    curr_fft_secondSensor = scipy.fftpack.fft(currSecondSensor)
-                    if "gyro" in firstSensor.lower():
-                        finalMatrix[:, j, k, n] = np.abs(curr_fft_secondSensor[:curr_fft_secondSensor.size / 2])
-                        finalMatrix[:, j, 3 + k, n] = np.abs(curr_fft_firstSensor[:curr_fft_firstSensor.size / 2])
-                        secondaryMatrix[0, j, k, n] = np.mean(currSecondSensor)
-                        secondaryMatrix[0, j, 3 + k, n] = np.mean(currFirstSensor)
-                        secondaryMatrix[1, j, k, n] = np.std(currSecondSensor)
-                        secondaryMatrix[1, j, 3 + k, n] = np.std(currFirstSensor)
-                        secondaryMatrix[2, j, k, n] = secondaryMatrix[1, j, k, n] / float(secondaryMatrix[0, j, k, n])
-                        secondaryMatrix[2, j, 3 + k, n] = secondaryMatrix[1, j, 3 + k, n] / float(
-                            secondaryMatrix[0, j, 3 + k, n])
-                        secondaryMatrix[3, j, k, n] = np.max(currSecondSensor) - np.min(currSecondSensor)
-                        secondaryMatrix[3, j, 3 + k, n] = np.max(currFirstSensor) - np.min(currFirstSensor)
-                        secondaryMatrix[4, j, k, n] = np.percentile(currSecondSensor, 10)
-                        secondaryMatrix[4, j, 3 + k, n] = np.percentile(currFirstSensor, 10)
-                        secondaryMatrix[5, j, k, n] = np.percentile(currSecondSensor, 25)
-                        secondaryMatrix[5, j, 3 + k, n] = np.percentile(currFirstSensor, 25)
-                        secondaryMatrix[6, j, k, n] = np.percentile(currSecondSensor, 50)
-                        secondaryMatrix[6, j, 3 + k, n] = np.percentile(currFirstSensor, 50)
-                        secondaryMatrix[7, j, k, n] = np.percentile(currSecondSensor, 75)
-                        secondaryMatrix[7, j, 3 + k, n] = np.percentile(currFirstSensor, 75)
-                        secondaryMatrix[8, j, k, n] = np.percentile(currSecondSensor, 90)
-                        secondaryMatrix[8, j, 3 + k, n] = np.percentile(currFirstSensor, 90)
-                        secondaryMatrix[9, j, k, n] = np.percentile(currSecondSensor, 75) - np.percentile(
-                            currSecondSensor, 25)
-                        secondaryMatrix[9, j, 3 + k, n] = np.percentile(currFirstSensor, 75) - np.percentile(
-                            currFirstSensor, 25)
-                        secondaryMatrix[10, j, k, n] = fehp.lag_one_autocorrelation(currSecondSensor)
-                        secondaryMatrix[10, j, 3 + k, n] = fehp.lag_one_autocorrelation(currFirstSensor)
-                        secondaryMatrix[11, j, k, n] = fehp.skewness(currSecondSensor)
-                        secondaryMatrix[11, j, 3 + k, n] = fehp.skewness(currFirstSensor)
-                        secondaryMatrix[12, j, k, n] = fehp.kurtosis(currSecondSensor)
-                        secondaryMatrix[12, j, 3 + k, n] = fehp.kurtosis(currFirstSensor)
-                        secondaryMatrix[13, j, k, n] = (np.linalg.norm(currSecondSensor)) ** 2
-                        secondaryMatrix[13, j, 3 + k, n] = (np.linalg.norm(currFirstSensor)) ** 2
-                        secondaryMatrix[14, j, k, n] = fehp.log_energy(currSecondSensor)
-                        secondaryMatrix[14, j, 3 + k, n] = fehp.log_energy(currFirstSensor)
-                        secondaryMatrix[15, j, k, n] = fehp.num_zero_crossings(currSecondSensor)
-                        secondaryMatrix[15, j, 3 + k, n] = fehp.num_zero_crossings(currFirstSensor)
-                    else:
-                        finalMatrix[:, j, k, n] = np.abs(curr_fft_firstSensor[:curr_fft_firstSensor.size / 2])
-                        finalMatrix[:, j, 3 + k, n] = np.abs(curr_fft_secondSensor[:curr_fft_secondSensor.size / 2])
-                        secondaryMatrix[0, j, k, n] = np.mean(currFirstSensor)
-                        secondaryMatrix[0, j, 3 + k, n] = np.mean(currSecondSensor)
-                        secondaryMatrix[1, j, k, n] = np.std(currFirstSensor)
-                        secondaryMatrix[1, j, 3 + k, n] = np.std(currSecondSensor)
-                        secondaryMatrix[2, j, k, n] = secondaryMatrix[1, j, k, n] / float(secondaryMatrix[0, j, k, n])
-                        secondaryMatrix[2, j, 3 + k, n] = secondaryMatrix[1, j, 3 + k, n] / float(
-                            secondaryMatrix[0, j, 3 + k, n])
-                        secondaryMatrix[3, j, k, n] = np.max(currFirstSensor) - np.min(currFirstSensor)
-                        secondaryMatrix[3, j, 3 + k, n] = np.max(currSecondSensor) - np.min(currSecondSensor)
-                        secondaryMatrix[4, j, k, n] = np.percentile(currFirstSensor, 10)
-                        secondaryMatrix[4, j, 3 + k, n] = np.percentile(currSecondSensor, 10)
-                        secondaryMatrix[5, j, k, n] = np.percentile(currFirstSensor, 25)
-                        secondaryMatrix[5, j, 3 + k, n] = np.percentile(currSecondSensor, 25)
-                        secondaryMatrix[6, j, k, n] = np.percentile(currFirstSensor, 50)
-                        secondaryMatrix[6, j, 3 + k, n] = np.percentile(currSecondSensor, 50)
-                        secondaryMatrix[7, j, k, n] = np.percentile(currFirstSensor, 75)
-                        secondaryMatrix[7, j, 3 + k, n] = np.percentile(currSecondSensor, 75)
-                        secondaryMatrix[8, j, k, n] = np.percentile(currFirstSensor, 90)
-                        secondaryMatrix[8, j, 3 + k, n] = np.percentile(currSecondSensor, 90)
-                        secondaryMatrix[9, j, k, n] = np.percentile(currFirstSensor, 75) - np.percentile(
-                            currFirstSensor, 25)
-                        secondaryMatrix[9, j, 3 + k, n] = np.percentile(currSecondSensor, 75) - np.percentile(
-                            currSecondSensor, 25)
-                        secondaryMatrix[10, j, k, n] = fehp.lag_one_autocorrelation(currFirstSensor)
-                        secondaryMatrix[10, j, 3 + k, n] = fehp.lag_one_autocorrelation(currSecondSensor)
-                        secondaryMatrix[11, j, k, n] = fehp.skewness(currFirstSensor)
-                        secondaryMatrix[11, j, 3 + k, n] = fehp.skewness(currSecondSensor)
-                        secondaryMatrix[12, j, k, n] = fehp.kurtosis(currFirstSensor)
-                        secondaryMatrix[12, j, 3 + k, n] = fehp.kurtosis(currSecondSensor)
-                        secondaryMatrix[13, j, k, n] = (np.linalg.norm(currFirstSensor)) ** 2
-                        secondaryMatrix[13, j, 3 + k, n] = (np.linalg.norm(currSecondSensor)) ** 2
-                        secondaryMatrix[14, j, k, n] = fehp.log_energy(currFirstSensor)
-                        secondaryMatrix[14, j, 3 + k, n] = fehp.log_energy(currSecondSensor)
-                        secondaryMatrix[15, j, k, n] = fehp.num_zero_crossings(currFirstSensor)
-                        secondaryMatrix[15, j, 3 + k, n] = fehp.num_zero_crossings(currSecondSensor)
-
-        print 'finalMatrix.shape: ', finalMatrix.shape
-
-        outputIntermediateArray = np.reshape(finalMatrix, (finalMatrix.shape[3], -1))
-        print 'outputIntermediateArray.shape: ', outputIntermediateArray.shape
-
-        secondaryIntermediateArray = np.reshape(secondaryMatrix, (finalMatrix.shape[3], -1))
-
-        # seventeenthFeatureMatrix is created to add the channel correlations to the statistical feature data
-        seventeenthFeatureMatrix = np.zeros((15, numColumns, totalNumOfLines / (50 * 2 * numSecondsPerImage)))
-        #     temp=np.zeros((50*fftWidth,numColumns,totalNumOfLines/(50*2*numSecondsPerImage)))
-
-        for n in range(finalMatrix.shape[3]):
-            for j in range(finalMatrix.shape[1]):
-                inde = 0
-                for k in range(3):
-                    for l in range(k + 1, 3):
-                        currFirstSensor1 = (data[(n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                            (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)), k + 2]).astype(
-                            float)
-                        currFirstSensor2 = (data[(n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                            (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)), l + 2]).astype(
-                            float)
-                        currSecondSensor1 = (data[counter + (n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                            counter + (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)),
-                                             k + 2]).astype(float)
-                        currSecondSensor2 = (data[counter + (n * 50 * numSecondsPerImage) + (j * 50 * fftJump): \
-                            counter + (n * 50 * numSecondsPerImage) + ((j * 50 * fftJump) + (50 * fftWidth)),
-                                             l + 2]).astype(float)
-
-                        seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currFirstSensor1, currFirstSensor2)
-                        inde += 1
-                        seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currSecondSensor1, currSecondSensor2)
-                        inde += 1
-                        seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currSecondSensor1, currFirstSensor2)
-                        inde += 1
-                        seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currSecondSensor2, currFirstSensor1)
-                        inde += 1
-                        if k == 0 and l == 2:
-                            seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currSecondSensor2, currFirstSensor2)
-                            inde += 1
-                        else:
-                            seventeenthFeatureMatrix[inde, j, n] = fehp.correlation(currSecondSensor1, currFirstSensor1)
-                            inde += 1
-
-        print 'seventeenthFeatureMatrix.shape: ', seventeenthFeatureMatrix.shape
-        outputThirdIntermediateArray = np.reshape(seventeenthFeatureMatrix, (finalMatrix.shape[3], -1))
-        secondaryIntermediateArray = np.concatenate((secondaryIntermediateArray, outputThirdIntermediateArray), axis=1)
-
-        intermediateOutputLabels = np.zeros((finalMatrix.shape[3], len(sports)))
-        intermediateOutputLabels[:, ind] = 1
-        print 'intermediateOutputLabels.shape for', sports[ind], ': ', intermediateOutputLabels.shape
-
-        if ind == 0:
-            outputLabels = intermediateOutputLabels
-            outputArray = outputIntermediateArray
-            outputSecondaryArray = secondaryIntermediateArray
+        firstSensorData  = data[:counter, 2:5]
+        secondSensorData = data[counter:, 2:5]
+
+    ## USED FOR PLOTTING
+    # firstSensor_unFormattedTime = data[0:counter, 1]
+    # firstSensor_Time = np.arange(firstSensor_unFormattedTime.shape[0]) / 50.0
+
+    # secondSensor_unFormattedTime = data[counter:, 1]
+    # secondSensor_Time = np.arange(secondSensor_unFormattedTime.shape[0]) / 50.0
+
+    # firstSensor_1 = data[:counter, 2]
+    # firstSensor_2 = data[:counter, 3]
+    # firstSensor_3 = data[:counter, 4]
+    # secondSensor_1 = data[counter:, 2]
+    # secondSensor_2 = data[counter:, 3]
+    # secondSensor_3 = data[counter:, 4]
+
+    # firstNtoIgnore = 20
+
+    # fft_firstSensor1 = scipy.fftpack.fft(firstSensor_1)
+    # fft_firstSensor1[0:firstNtoIgnore] = 0
+    # fft_firstSensor2 = scipy.fftpack.fft(firstSensor_2)
+    # fft_firstSensor2[0:firstNtoIgnore] = 0
+    # fft_firstSensor3 = scipy.fftpack.fft(firstSensor_3)
+    # fft_firstSensor3[0:firstNtoIgnore] = 0
+    # fft_secondSensor1 = scipy.fftpack.fft(secondSensor_1)
+    # fft_secondSensor1[0:firstNtoIgnore] = 0
+    # fft_secondSensor2 = scipy.fftpack.fft(secondSensor_2)
+    # fft_secondSensor2[0:firstNtoIgnore] = 0
+    # fft_secondSensor3 = scipy.fftpack.fft(secondSensor_3)
+    # fft_secondSensor3[0:firstNtoIgnore] = 0
+    #
+    # x_firstSensor1 = np.linspace(0, 25, fft_firstSensor1.size / 2)
+    # x_firstSensor2 = np.linspace(0, 25, fft_firstSensor2.size / 2)
+    # x_firstSensor3 = np.linspace(0, 25, fft_firstSensor3.size / 2)
+    # x_secondSensor1 = np.linspace(0, 25, fft_secondSensor1.size / 2)
+    # x_secondSensor2 = np.linspace(0, 25, fft_secondSensor2.size / 2)
+    # x_secondSensor3 = np.linspace(0, 25, fft_secondSensor3.size / 2)
+
+    return firstSensor, firstSensorData.astype(float), secondSensorData.astype(float)
+
+
+def extract_features(firstSensor, firstSensorData, secondSensorData, numSecondsPerImage=30, fftWidth=6, fftJump=2):
+    """
+    Extracts the FFT and statistical features of one sport (see feature_extraction).
+    :param firstSensor: name of the first sensor in the Final file
+    :param firstSensorData: (rows x 3) float array of the first sensor
+    :param secondSensorData: (rows x 3) float array of the second sensor
+    :param numSecondsPerImage:
+    :param fftWidth:
+    :param fftJump:
+    :return: (samples x features) arrays of FFT features and of statistical features
+    """
+    numSamples = (firstSensorData.shape[0] + secondSensorData.shape[0]) / (50 * 2 * numSecondsPerImage)
+    return flatten_features(*feature_matrices(firstSensor, firstSensorData, secondSensorData, numSamples,
+                                              numSecondsPerImage=numSecondsPerImage, fftWidth=fftWidth,
+                                              fftJump=fftJump))
+
+
+def feature_matrices(firstSensor, firstSensorData, secondSensorData, numSamples, numSecondsPerImage=30, fftWidth=6,
+                     fftJump=2):
+    """
+    Computes the feature matrices of the first numSamples samples of the sensor data. Samples are independent of each
+    other, so the matrices of consecutive blocks of samples can be concatenated along their last axis.
+    :param firstSensor: name of the first sensor in the Final file
+    :param firstSensorData: (rows x 3) float array of the first sensor
+    :param secondSensorData: (rows x 3) float array of the second sensor
+    :param numSamples: number of samples
+    :param numSecondsPerImage:
+    :param fftWidth:
+    :param fftJump:
+    :return: FFT features (frequency x time x channel x sample), statistical features (16 x time x channel x sample)
+             and channel correlations (15 x time x sample)
+    """
+    numColumns = (numSecondsPerImage - fftWidth) / fftJump + 1  # total no of columns to include in one image
+
+    # 6 is the number of sensors, finalMatrix corresponds to FFT features, secondaryMatrix corresponds to statistical
+    finalMatrix = np.zeros((((50 * fftWidth) / 2), numColumns, 6, numSamples))
+    secondaryMatrix = np.zeros((16, numColumns, 6, numSamples))
+
+    # all overlapping windows of both sensor streams, as (sample, time, window length, axis) strided views
+    firstSensorWindows  = fehp.sliding_windows(firstSensorData, numSamples, numColumns, 50 * fftWidth,
+                                               50 * numSecondsPerImage, 50 * fftJump)
+    secondSensorWindows = fehp.sliding_windows(secondSensorData, numSamples, numColumns, 50 * fftWidth,
+                                               50 * numSecondsPerImage, 50 * fftJump)
+
+    # FFT features of all windows at once, in finalMatrix's (frequency, time, channel, sample) layout
+    if "gyro" in firstSensor.lower():
+        finalMatrix[:, :, :3, :] = fehp.stft_magnitudes(secondSensorWindows).transpose(2, 1, 3, 0)
+        finalMatrix[:, :, 3:, :] = fehp.stft_magnitudes(firstSensorWindows).transpose(2, 1, 3, 0)
+    else:
+        finalMatrix[:, :, :3, :] = fehp.stft_magnitudes(firstSensorWindows).transpose(2, 1, 3, 0)
+        finalMatrix[:, :, 3:, :] = fehp.stft_magnitudes(secondSensorWindows).transpose(2, 1, 3, 0)
+
+    # statistical features of all windows at once
+    if "gyro" in firstSensor.lower():
+        secondaryMatrix[:, :, :3, :] = fehp.statistical_features(secondSensorWindows)
+        secondaryMatrix[:, :, 3:, :] = fehp.statistical_features(firstSensorWindows)
+    else:
+        secondaryMatrix[:, :, :3, :] = fehp.statistical_features(firstSensorWindows)
+        secondaryMatrix[:, :, 3:, :] = fehp.statistical_features(secondSensorWindows)
+
+    # seventeenthFeatureMatrix is created to add the channel correlations to the statistical feature data
+    seventeenthFeatureMatrix = np.zeros((15, numColumns, numSamples))
+    #     temp=np.zeros((50*fftWidth,numColumns,totalNumOfLines/(50*2*numSecondsPerImage)))
+
+    seventeenthFeatureMatrix[:] = fehp.channel_correlations(firstSensorWindows, secondSensorWindows)
+
+    return finalMatrix, secondaryMatrix, seventeenthFeatureMatrix
+
+
+def flatten_features(finalMatrix, secondaryMatrix, seventeenthFeatureMatrix):
+    """
+    Turns the feature matrices of all samples of a sport (see feature_matrices) into the rows of the feature files.
+    :param finalMatrix: FFT features
+    :param secondaryMatrix: statistical features
+    :param seventeenthFeatureMatrix: channel correlations
+    :return: (samples x features) arrays of FFT features and of statistical features
+    """
+    print 'finalMatrix.shape: ', finalMatrix.shape
+
+    outputIntermediateArray = np.reshape(finalMatrix, (finalMatrix.shape[3], -1))
+    print 'outputIntermediateArray.shape: ', outputIntermediateArray.shape
+
+    secondaryIntermediateArray = np.reshape(secondaryMatrix, (finalMatrix.shape[3], -1))
+
+    print 'seventeenthFeatureMatrix.shape: ', seventeenthFeatureMatrix.shape
+    outputThirdIntermediateArray = np.reshape(seventeenthFeatureMatrix, (finalMatrix.shape[3], -1))
+    secondaryIntermediateArray = np.concatenate((secondaryIntermediateArray, outputThirdIntermediateArray), axis=1)
+
+    return outputIntermediateArray, secondaryIntermediateArray
+
+
+def feature_blocks(firstSensor, fileName, firstSensorData, secondSensorData, numSecondsPerImage, configs,
+                   binaryInput=False, blockSize=64):
+    """
+    Splits the samples of one sport into blocks for extract_features_block.
+    :param firstSensor: name of the first sensor in the Final file
+    :param fileName: path of the Final file
+    :param firstSensorData: (rows x 3) array of the first sensor
+    :param secondSensorData: (rows x 3) array of the second sensor
+    :param numSecondsPerImage:
+    :param configs: list of (fftWidth, fftJump) configurations
+    :param binaryInput: if True, workers memory-map the binary file themselves instead of receiving the rows
+    :param blockSize: number of samples per block
+    :return: list of extract_features_block arguments, in sample order
+    """
+    rowsPerSample = 50 * numSecondsPerImage
+    numSamples = (firstSensorData.shape[0] + secondSensorData.shape[0]) / (2 * rowsPerSample)
+    blocks = []
+    for firstSample in range(0, numSamples, blockSize):
+        blockSamples = min(blockSize, numSamples - firstSample)
+        rows = slice(firstSample * rowsPerSample, (firstSample + blockSamples) * rowsPerSample)
+        if binaryInput:
+            source = (fileName, rows)
         else:
-            outputLabels = np.concatenate((outputLabels, intermediateOutputLabels))
-            outputArray = np.concatenate((outputArray, outputIntermediateArray))
-            outputSecondaryArray = np.concatenate((outputSecondaryArray, secondaryIntermediateArray))
+            source = (firstSensorData[rows], secondSensorData[rows])
+        blocks.append((firstSensor, source, blockSamples, numSecondsPerImage, configs))
+    return blocks
+
+
+def extract_features_block(args):
+    """
+    Pool worker: computes the feature matrices of a block of samples of one sport for every configuration.
+    :param args: (first sensor name, source, number of samples, numSecondsPerImage, configs), where source is either
+                 the rows of both sensors or the path of a binary Final file and the slice of its rows
+    :return: list of (finalMatrix, secondaryMatrix, seventeenthFeatureMatrix), one per configuration
+    """
+    firstSensor, source, numSamples, numSecondsPerImage, configs = args
+    if isinstance(source[0], basestring):
+        fileName, rows = source
+        _, _, firstSensorData, secondSensorData = fehp.load_binary_sensor_data(fileName)
+        firstSensorData, secondSensorData = firstSensorData[rows], secondSensorData[rows]
+    else:
+        firstSensorData, secondSensorData = source
+
+    firstSensorData = np.asarray(firstSensorData, dtype=float)
+    secondSensorData = np.asarray(secondSensorData, dtype=float)
+    return [feature_matrices(firstSensor, firstSensorData, secondSensorData, numSamples,
+                             numSecondsPerImage=numSecondsPerImage, fftWidth=fftWidth, fftJump=fftJump)
+            for fftWidth, fftJump in configs]
 
-    print '\noutputArray.shape: ', outputArray.shape
-    print 'outputSecondaryArray.shape: ', outputSecondaryArray.shape
-    print 'outputLabels.shape: ', outputLabels.shape
 
+def feature_files(finalOrNew=0, fileSuffix='', outputFormat='csv'):
+    """
+    Paths of the files in which the extracted features are saved.
+    :param finalOrNew: 0 for Final, 1 for newPerson
+    :param fileSuffix: suffix added to the file names
+    :param outputFormat: 'csv' or 'npy' (see feature_extraction)
+    :return: paths of the features, secondary features and labels files
+    """
     if finalOrNew == 1:
-        np.savetxt('../Data/newPersonFeaturesFinal.csv', outputArray, delimiter=', ')
-        np.savetxt('../Data/newPersonSecondaryFeaturesFinal.csv', outputSecondaryArray, delimiter=', ')
-        np.savetxt('../Data/newPersonLabelsFinal.csv', outputLabels, fmt='%d', delimiter=', ')
+        return ('../Data/newPersonFeaturesFinal' + fileSuffix + '.' + outputFormat,
+                '../Data/newPersonSecondaryFeaturesFinal' + fileSuffix + '.' + outputFormat,
+                '../Data/newPersonLabelsFinal' + fileSuffix + '.' + outputFormat)
+    return ('../Data/featuresFinal' + fileSuffix + '.' + outputFormat,
+            '../Data/secondaryFeaturesFinal' + fileSuffix + '.' + outputFormat,
+            '../Data/labelsFinal' + fileSuffix + '.' + outputFormat)
+
+
+def count_samples(fileName, numSecondsPerImage=30, binaryInput=False):
+    """
+    Counts the samples of a Final file without loading it.
+    :param fileName: path of the Final file
+    :param numSecondsPerImage:
+    :param binaryInput: see feature_extraction
+    :return: number of samples the features are extracted from
+    """
+    if binaryInput:
+        headerFile = fehp.binary_header_file(fileName)
+        if headerFile is None:
+            return 0
+        with open(headerFile, 'r') as fileStream:
+            totalNumOfLines = sum(json.load(fileStream)['lengths'])
     else:
-        np.savetxt('../Data/featuresFinal.csv', outputArray, delimiter=', ')
-        np.savetxt('../Data/secondaryFeaturesFinal.csv', outputSecondaryArray, delimiter=', ')
-        np.savetxt('../Data/labelsFinal.csv', outputLabels, fmt='%d', delimiter=', ')
+        totalNumOfLines = fehp.file_len(fileName)
+    return totalNumOfLines / (50 * 2 * numSecondsPerImage)
+
+
+def num_features(numSecondsPerImage=30, fftWidth=6, fftJump=2):
+    """
+    :param numSecondsPerImage:
+    :param fftWidth:
+    :param fftJump:
+    :return: number of FFT features and number of statistical features per sample
+    """
+    numColumns = (numSecondsPerImage - fftWidth) / fftJump + 1
+    return ((50 * fftWidth) / 2) * numColumns * 6, 16 * numColumns * 6 + 15 * numColumns
+
+
+class FeatureWriter(object):
+    """
+    Writes the features of consecutive sports straight into their place in the output files, so that only the
+    features of the current sport are held in memory.
+    """
+    def __init__(self, numSamples, numFeatures, numSecondaryFeatures, numSports, finalOrNew=0, fileSuffix='',
+                 outputFormat='csv', featureDtype=np.float64):
+        """
+        :param numSamples: total number of samples of all sports
+        :param numFeatures: number of FFT features per sample
+        :param numSecondaryFeatures: number of statistical features per sample
+        :param numSports: number of sports (label columns)
+        :param finalOrNew: 0 for Final, 1 for newPerson
+        :param fileSuffix: suffix added to the file names
+        :param outputFormat: 'csv' or 'npy' (see feature_extraction)
+        :param featureDtype: dtype the features are stored with
+        """
+        if outputFormat not in ['csv', 'npy']:
+            raise ValueError('Unknown output format: ' + str(outputFormat))
+        self.files = feature_files(finalOrNew=finalOrNew, fileSuffix=fileSuffix, outputFormat=outputFormat)
+        self.shapes = [(numSamples, numFeatures), (numSamples, numSecondaryFeatures), (numSamples, numSports)]
+        self.dtypes = [featureDtype, featureDtype, np.int8]
+        self.outputFormat = outputFormat
+        self.row = 0
+
+        if outputFormat == 'npy':
+            self.outputs = []
+            for fileName, shape, dtype in zip(self.files, self.shapes, self.dtypes):
+                if numSamples == 0:
+                    # open_memmap cannot map an empty file
+                    np.save(fileName, np.zeros(shape, dtype=dtype))
+                    self.outputs.append(None)
+                else:
+                    self.outputs.append(np.lib.format.open_memmap(fileName, mode='w+', dtype=dtype, shape=shape))
+        else:
+            self.outputs = [open(fileName, 'w') for fileName in self.files]
+
+    def write(self, outputArray, outputSecondaryArray, outputLabels):
+        """
+        Writes the features of the next sport.
+        :param outputArray: (samples x features) array of FFT features
+        :param outputSecondaryArray: (samples x features) array of statistical features
+        :param outputLabels: (samples x sports) array of one-hot labels
+        :return: Nothing
+        """
+        numRows = outputArray.shape[0]
+        assert self.row + numRows <= self.shapes[0][0]  # sanity check against the up front count
+        for output, block, dtype in zip(self.outputs, [outputArray, outputSecondaryArray, outputLabels], self.dtypes):
+            if self.outputFormat == 'npy':
+                output[self.row:self.row + numRows] = block
+            elif dtype == np.int8:
+                np.savetxt(output, block, fmt='%d', delimiter=', ')
+            else:
+                np.savetxt(output, block.astype(dtype), delimiter=', ')
+        self.row += numRows
+
+    def close(self):
+        """
+        :return: paths of the features, secondary features and labels files
+        """
+        assert self.row == self.shapes[0][0]  # sanity check against the up front count
+        for output in self.outputs:
+            if self.outputFormat == 'npy':
+                if output is not None:
+                    output.flush()
+            else:
+                output.close()
+        self.outputs = []
+        return self.files
+
 
 ################################################################
 ## PLOTTING
@@ -2,6 +2,8 @@ import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import numpy as np
+import scipy.fftpack
+import json
 import os
 
 
@@ -19,6 +21,134 @@ def file_len(fname):
     else:
         return 0
 
+def binary_header_file(fname):
+    """
+    Finds the header of the binary version of a Final file (see DataPreprocessing.write_binary_output)
+    :param fname: path of the text version of the file (e.g. '../Data/Running/Final.csv')
+    :return: path of the header, or None if neither version of the file exists
+    """
+    header_file = fname[:-4] + '.json'
+    if os.path.exists(header_file):
+        return header_file
+    if os.path.exists(fname) and os.path.getsize(fname) > 0:
+        raise IOError('No binary version of ' + fname + ', run DataPreprocessing.data_preprocessing with '
+                      'binaryOutput=True or extract the features with binaryInput=False')
+    return None
+
+def load_binary_sensor_data(fname):
+    """
+    Memory-maps the binary version of a Final file (see DataPreprocessing.write_binary_output)
+    :param fname: path of the text version of the file (e.g. '../Data/Running/Final.csv')
+    :return: names of the first and second sensors, and their (samples x 3) float32 arrays
+             (None for the arrays if there is nothing to load)
+    """
+    header_file = binary_header_file(fname)
+    if header_file is None:
+        return None, None, None, None
+    with open(header_file) as f:
+        header = json.load(f)
+    if sum(header['lengths']) == 0:
+        return header['sensors'][0], header['sensors'][1], None, None
+
+    # plain ndarray views of the memory maps (slicing np.memmap objects has a noticeable per-slice overhead)
+    arrays = [np.asarray(np.load(os.path.join(os.path.dirname(fname), array_file), mmap_mode='r'))
+              for array_file in header['files']]
+    return header['sensors'][0], header['sensors'][1], arrays[0], arrays[1]
+
+def sliding_windows(arra, num_samples, num_windows, window_length, sample_step, window_step):
+    """
+    Builds all overlapping windows of a sensor stream as a strided view (no data is copied)
+    :param arra: (rows x channels) array of sensor values
+    :param num_samples: number of samples (images)
+    :param num_windows: number of windows (time columns) per sample
+    :param window_length: number of rows in a window
+    :param sample_step: number of rows between the starts of two samples
+    :param window_step: number of rows between the starts of two windows of a sample
+    :return: (num_samples x num_windows x window_length x channels) view of arra
+    """
+    arra = np.ascontiguousarray(arra)
+    last_row = (num_samples - 1) * sample_step + (num_windows - 1) * window_step + window_length
+    if num_samples > 0 and last_row > arra.shape[0]:
+        raise ValueError('Not enough rows (%d) for %d samples of %d windows' % (arra.shape[0], num_samples,
+                                                                                  num_windows))
+    return np.lib.stride_tricks.as_strided(arra, shape=(num_samples, num_windows, window_length, arra.shape[1]),
+                                           strides=(sample_step * arra.strides[0], window_step * arra.strides[0],
+                                                    arra.strides[0], arra.strides[1]))
+
+def stft_magnitudes(windows):
+    """
+    Computes the FFT magnitudes of a batch of windows in one call
+    :param windows: (samples x time x window length x channels) array, e.g. from sliding_windows
+    :return: (samples x time x window length / 2 x channels) array of the magnitudes of the first half of the FFT
+    """
+    return np.abs(scipy.fftpack.fft(windows, axis=2)[:, :, :windows.shape[2] / 2, :])
+
+def statistical_features(windows):
+    """
+    Computes the 16 statistical features of a batch of windows in vectorized passes.
+    Same values as the scalar functions below (up to floating point summation order).
+    :param windows: (samples x time x window length x channels) array, e.g. from sliding_windows
+    :return: (16 x time x channels x samples) array with rows: 1.mean; 2.standard deviation; 3.coefficient of
+             variation; 4.peak-to-peak amplitude; 5-9.10th, 25th, 50th, 75th, 90th percentiles; 10.inter-quartile
+             range; 11.lag-one autocorrelation; 12.skewedness; 13.kurtosis; 14.signal power; 15.log-energy;
+             16.zero-crossings
+    """
+    # (samples x time x channels x window length), so that every reduction runs over contiguous memory
+    arra = np.ascontiguousarray(np.transpose(windows, (0, 1, 3, 2)))
+    size = arra.shape[-1]
+
+    features = np.zeros((16,) + arra.shape[:-1])
+    features[0] = np.mean(arra, axis=-1)
+    features[1] = np.std(arra, axis=-1)
+    features[2] = features[1] / features[0]
+    features[3] = np.max(arra, axis=-1) - np.min(arra, axis=-1)
+    features[4:9] = np.percentile(arra, [10, 25, 50, 75, 90], axis=-1)
+    features[9] = features[7] - features[5]
+
+    centered = arra - features[0][..., np.newaxis]
+    variance = features[1] ** 2
+    features[10] = np.sum(centered[..., :-1] * centered[..., 1:], axis=-1) / (variance * size)
+    features[11] = (np.sum(centered ** 3, axis=-1) / float(size)) / features[1] ** 3
+    features[12] = (np.sum(centered ** 4, axis=-1) / float(size)) / features[1] ** 6 - 3
+    features[13] = np.linalg.norm(arra, axis=-1) ** 2
+    features[14] = np.sum(np.log(np.where(arra == 0, 1, arra ** 2)), axis=-1)
+    features[15] = np.sum(np.diff(np.sign(centered), axis=-1) != 0, axis=-1)
+
+    return np.transpose(features, (0, 2, 3, 1))
+
+def channel_correlations(first_windows, second_windows):
+    """
+    Computes the 15 correlations between the channels of the two sensors for a batch of windows.
+    Same values and order as the calls to correlation in the original per-window loop.
+    :param first_windows: (samples x time x window length x 3) windows of the first sensor in the Final file
+    :param second_windows: (samples x time x window length x 3) windows of the second sensor in the Final file
+    :return: (15 x time x samples) array of correlations
+    """
+    centered = []
+    denoms = []
+    for windows in [first_windows, second_windows]:
+        arra = np.ascontiguousarray(np.transpose(windows, (0, 1, 3, 2)))
+        centered.append(arra - np.mean(arra, axis=-1)[..., np.newaxis])
+        denoms.append((np.std(arra, axis=-1) ** 2) * arra.shape[-1])
+
+    # (sensor, axis) pairs in the order of the original loop: F = first sensor, S = second sensor
+    pairs = []
+    for k in range(3):
+        for l in range(k + 1, 3):
+            pairs += [((0, k), (0, l)), ((1, k), (1, l)), ((1, k), (0, l)), ((1, l), (0, k))]
+            if k == 0 and l == 2:
+                pairs.append(((1, l), (0, l)))
+            else:
+                pairs.append(((1, k), (0, k)))
+
+    correlations = np.zeros((len(pairs),) + centered[0].shape[:2])
+    for ind in range(len(pairs)):
+        (sensor1, axis1), (sensor2, axis2) = pairs[ind]
+        num = np.sum(centered[sensor1][:, :, axis1] * centered[sensor2][:, :, axis2], axis=-1)
+        correlations[ind] = num / (denoms[sensor1][:, :, axis1] * denoms[sensor2][:, :, axis2])
+
+    return np.transpose(correlations, (0, 2, 1))
+
 def lag_one_autocorrelation(arra):
     denom=((np.std(arra))**2)*arra.size
     summ=0
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+class FeatureStore(object):
+    """
+    On-disk store of extracted feature files, addressed by the content of the pre-processed input files and the
+    feature extraction parameters. Entries are evicted in least recently used order once the store grows beyond
+    maxBytes. Entries handed out by get or put are pinned until they are released, so that their paths stay valid
+    while they are in use.
+    """
+    def __init__(self, storeDir='../Data/FeatureStore', maxBytes=2 * 1024 ** 3):
+        """
+        :param storeDir: directory of the store (created if needed)
+        :param maxBytes: size cap of the store in bytes
+        """
+        self.storeDir = storeDir
+        self.maxBytes = maxBytes
+        self.indexFile = os.path.join(storeDir, 'index.json')
+        self.pinned = set()
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir)
+
+    def input_digest(self, inputFiles):
+        """
+        Hashes the content of the input files. Digests are remembered per file along with its size and mtime, so
+        unchanged files are not read again.
+        :param inputFiles: list of paths of the input files (missing files are hashed as missing)
+        :return: hex digest of all input files, in order
+        """
+        index = self._read_index()
+        digests = index['inputs']
+        digest = hashlib.sha1()
+        for fileName in inputFiles:
+            digest.update(fileName + ':')
+            if not os.path.exists(fileName):
+                digest.update('missing;')
+                continue
+            path = os.path.abspath(fileName)
+            stat = os.stat(fileName)
+            known = digests.get(path)
+            if known is None or known['size'] != stat.st_size or known['mtime'] != stat.st_mtime:
+                fileDigest = hashlib.sha1()
+                with open(fileName, 'rb') as fileStream:
+                    for block in iter(lambda: fileStream.read(1 << 20), ''):
+                        fileDigest.update(block)
+                known = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': fileDigest.hexdigest()}
+                digests[path] = known
+            digest.update(known['sha1'] + ';')
+        self._write_index(index)
+        return digest.hexdigest()
+
+    def key(self, inputDigest, **params):
+        """
+        :param inputDigest: digest of the input files (see input_digest)
+        :param params: parameters the stored files depend on
+        :return: key of the entry
+        """
+        digest = hashlib.sha1(inputDigest)
+        digest.update(json.dumps(params, sort_keys=True))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up an entry, marks it as recently used and pins it (see release).
+        :param key: key of the entry
+        :return: paths of the stored files, or None if the entry is not in the store
+        """
+        index = self._read_index()
+        entry = index['entries'].get(key)
+        if entry is None:
+            return None
+        files = [os.path.join(self.storeDir, key, f) for f in entry['files']]
+        if not all(os.path.exists(f) for f in files):
+            self._remove(index, key)
+            self._write_index(index)
+            return None
+        entry['lastUsed'] = time.time()
+        self.pinned.add(key)
+        self._write_index(index)
+        return files
+
+    def put(self, key, files):
+        """
+        Moves files into the store as a new, pinned entry (see release) and evicts least recently used entries that
+        are not pinned to stay under maxBytes.
+        :param key: key of the entry
+        :param files: paths of the files to store (file names must be distinct)
+        :return: paths of the stored files
+        """
+        index = self._read_index()
+        self._remove(index, key)
+        entryDir = os.path.join(self.storeDir, key)
+        os.makedirs(entryDir)
+        storedFiles = []
+        for f in files:
+            storedFile = os.path.join(entryDir, os.path.basename(f))
+            shutil.move(f, storedFile)
+            storedFiles.append(storedFile)
+        index['entries'][key] = {'files': [os.path.basename(f) for f in storedFiles],
+                                 'size': sum(os.path.getsize(f) for f in storedFiles),
+                                 'lastUsed': time.time()}
+        self.pinned.add(key)
+
+        self._evict(index)
+        self._write_index(index)
+        return storedFiles
+
+    def release(self, files):
+        """
+        Unpins the entries holding the given files, which may then be evicted, and evicts least recently used entries
+        that are not pinned to stay under maxBytes.
+        :param files: paths returned by get or put (None and paths outside the store are ignored)
+        :return: Nothing
+        """
+        for f in files:
+            if f is not None and os.path.dirname(os.path.dirname(os.path.abspath(f))) == os.path.abspath(self.storeDir):
+                self.pinned.discard(os.path.basename(os.path.dirname(f)))
+        index = self._read_index()
+        self._evict(index)
+        self._write_index(index)
+
+    def _evict(self, index):
+        totalSize = sum(entry['size'] for entry in index['entries'].values())
+        for oldKey in sorted(index['entries'], key=lambda k: index['entries'][k]['lastUsed']):
+            if totalSize <= self.maxBytes:
+                break
+            if oldKey not in self.pinned:
+                totalSize -= index['entries'][oldKey]['size']
+                self._remove(index, oldKey)
+
+    def _remove(self, index, key):
+        index['entries'].pop(key, None)
+        shutil.rmtree(os.path.join(self.storeDir, key), ignore_errors=True)
+
+    def _read_index(self):
+        if not os.path.exists(self.indexFile):
+            return {'entries': {}, 'inputs': {}}
+        with open(self.indexFile, 'r') as fileStream:
+            return json.load(fileStream)
+
+    def _write_index(self, index):
+        with open(self.indexFile + '.tmp', 'w') as fileStream:
+            json.dump(index, fileStream)
+        os.rename(self.indexFile + '.tmp', self.indexFile)
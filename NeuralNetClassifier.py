@@ -1,35 +1,83 @@
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+import itertools
+import multiprocessing
+import os
+import tempfile
 import numpy as np
 import tensorflow as tf
-from sklearn.decomposition import PCA
 import ClassifierHelperFunctions as hf
+import ClassifierEvaluation as ce
 import NeuralNetModel as nnmodel
 
 
 def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Running', 'Skating', 'Walking'],
+                              featuresFile='../Data/featuresFinal.csv',
+                              labelsFile='../Data/labelsFinal.csv',
+                              newPersonFeaturesFile='../Data/newPersonFeaturesFinal.csv',
+                              newPersonLabelsFile='../Data/newPersonLabelsFinal.csv',
                               freqDims=150,
                               timeDims=13,
                               channels=6,
                               num_pca_components=200,
                               pca_whiten=True,
+                              pca_fit_components=0,
+                              pca_backend='auto',
                               hidden_sizes=[1024, 1024],
                               verbose=False,
                               show_val_acc=True,
-                              algoSwitch=0):
+                              algoSwitch=0,
+                              split_seed=None,
+                              intra_op_threads=0,
+                              inter_op_threads=1,
+                              search_mode='sequential',
+                              models_per_graph=16,
+                              search_workers=None,
+                              search_pool=None,
+                              halving_factor=3,
+                              batch_size=25,
+                              input_pipeline=False):
     """
     Loads data, and runs a neural network classifier to classify activities.
     :param sports: List of names of activities in data set
+    :param featuresFile: path of the features file
+    :param labelsFile: path of the labels file
+    :param newPersonFeaturesFile: path of the new person features file (used if algoSwitch > 1)
+    :param newPersonLabelsFile: path of the new person labels file (used if algoSwitch > 1)
     :param freqDims: Number of steps in frequency dimension in input feature data
     :param timeDims: Number of steps in time dimension in input feature data
     :param channels: Number of channels in input feature data
     :param num_pca_components: Number of components wanted after PCA
     :param pca_whiten: Set True to whiten the PCA data
+    :param pca_fit_components: Number of components the PCAs are fitted with, if larger than num_pca_components (the
+                               fit is cached, so that later calls with up to pca_fit_components reuse it)
+    :param pca_backend: 'auto', 'full' or 'randomized' (the svd_solver of sklearn's PCA), or 'incremental' to fit the
+                        PCAs chunk by chunk from the (possibly memory-mapped) features file
     :param hidden_sizes: list of sizes for the hidden layers
     :param verbose: Set True to display iteration logs
     :param show_val_acc: Set True to show average validation accuracies in hyperparameter searches
     :param algoSwitch: 0 or 1 means no newPerson set... if > 1 use newPerson set for additional testing
+    :param split_seed: seed of the train/test split (None for a different split on every run)
+    :param intra_op_threads: Number of threads tensorflow uses within an op (0 for one per core)
+    :param inter_op_threads: Number of ops tensorflow runs concurrently (the layers run one after another, so 1 avoids
+                             oversubscribing the cores)
+    :param search_mode: 'sequential' to train the hyperparameter search models one after another, 'batched' to
+                        train models_per_graph of them at once with a BatchedNeuralNetModel, or 'halving' to run a
+                        successive halving search on a pool of search_workers processes
+    :param models_per_graph: Number of models trained at once in the 'batched' search mode (the weights and Adam
+                             state of every model are held in memory together)
+    :param search_workers: Number of processes of the 'halving' search mode (None for one per core), if search_pool
+                           is None
+    :param search_pool: Pool of the 'halving' search mode (see create_search_pool), shared by all calls of a run; if
+                        None, a pool is created for this call, which is only safe while this process has not started
+                        tensorflow, because the pool workers are forked
+    :param halving_factor: Fraction (1 / halving_factor) of hyperparameter pairs kept after each round of the
+                           'halving' search mode, which also trains halving_factor times as many epochs per round
+    :param batch_size: Minibatch size of the training steps
+    :param input_pipeline: Set True to gather the minibatches of the neural net in the tensorflow graph, in an order
+                           shuffled every epoch, instead of feeding them from numpy in the order of the rows (the
+                           'batched' search mode always feeds its minibatches)
     :return: Nothing
     """
 
@@ -39,22 +87,26 @@ def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Ru
     ## LOAD DATA
     print '\nLoading data...'
 
-    data = hf.load_data('../Data/featuresFinal.csv', '../Data/labelsFinal.csv')
-    train_features = data['train_features'].reshape((-1,freqDims*timeDims,channels))
-    train_labels   = data['train_labels']
-    test_features  = data['test_features'].reshape((-1,freqDims*timeDims,channels))
-    test_labels    = data['test_labels']
+    # the (possibly memory-mapped) features are only read by the PCA stage, through the indices of each set
+    data = hf.load_data(featuresFile, labelsFile, seed=split_seed, indicesOnly=True)
+    features      = data['features'].reshape((-1,freqDims*timeDims,channels))
+    train_indices = data['train_indices']
+    train_labels  = data['labels'][train_indices]
+    test_indices  = data['test_indices']
+    test_labels   = data['labels'][test_indices]
 
     if algoSwitch > 1:
-        newPerson_data = hf.load_data('../Data/newPersonFeaturesFinal.csv', '../Data/newPersonLabelsFinal.csv', newPerson=True)
-        newPerson_test_features = newPerson_data['test_features'].reshape((-1,freqDims*timeDims,channels))
-        newPerson_test_labels   = newPerson_data['test_labels']
+        newPerson_data = hf.load_data(newPersonFeaturesFile, newPersonLabelsFile, newPerson=True, seed=split_seed,
+                                      indicesOnly=True)
+        newPerson_features      = newPerson_data['features'].reshape((-1,freqDims*timeDims,channels))
+        newPerson_test_indices  = newPerson_data['test_indices']
+        newPerson_test_labels   = newPerson_data['labels'][newPerson_test_indices]
 
     print 'Data loaded!'
-    print 'Training set:       ', train_features.shape[0]
-    print 'Test set:           ', test_features.shape[0]
+    print 'Training set:       ', len(train_indices)
+    print 'Test set:           ', len(test_indices)
     if algoSwitch > 1:
-        print 'New person test set:', newPerson_test_features.shape[0]
+        print 'New person test set:', len(newPerson_test_indices)
 
 
     ################################################################
@@ -64,21 +116,20 @@ def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Ru
     if num_pca_components > freqDims*timeDims:
         num_pca_components = freqDims*timeDims
 
-    reduced_train_features = np.zeros((train_features.shape[0], num_pca_components, channels))
-    reduced_test_features = np.zeros((test_features.shape[0], num_pca_components, channels))
+    # the PCAs are fitted once at the largest number of components the caller asks for, and reused for all
+    # smaller ones (and by the other classifier) while the training features stay the same
+    pcas = hf.fit_channel_pcas(features, min(max(num_pca_components, pca_fit_components), freqDims*timeDims),
+                               backend=pca_backend, indices=train_indices)
+    reduced_train_features = hf.project_channels(features, pcas, num_pca_components, whiten=pca_whiten,
+                                                 indices=train_indices)
+    reduced_test_features = hf.project_channels(features, pcas, num_pca_components, whiten=pca_whiten,
+                                                indices=test_indices)
     if algoSwitch > 1:
-        reduced_newPerson_test_features = np.zeros((newPerson_test_features.shape[0], num_pca_components, channels))
-
-
-    for c in range(channels):
-        pca = PCA(n_components=num_pca_components, whiten=pca_whiten)
-        reduced_train_features[:,:,c] = pca.fit_transform(train_features[:,:,c])
-        reduced_test_features[:,:,c]  = pca.transform(test_features[:,:,c])
-        if algoSwitch > 1:
-            reduced_newPerson_test_features[:, :, c] = pca.transform(newPerson_test_features[:, :, c])
+        reduced_newPerson_test_features = hf.project_channels(newPerson_features, pcas, num_pca_components,
+                                                              whiten=pca_whiten, indices=newPerson_test_indices)
 
     print 'Dimensionality reduced!'
-    print 'Old feature dimensions:', train_features.shape[1]*train_features.shape[2]
+    print 'Old feature dimensions:', features.shape[1]*features.shape[2]
     print 'New feature dimensions:', reduced_train_features.shape[1]*reduced_train_features.shape[2]
 
 
@@ -94,40 +145,93 @@ def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Ru
     keep_probs = np.linspace(0.25,1,4)
     num_folds = 4
 
-    for lr in lrs:
-        for keep_prob in keep_probs:
-            avg_val_acc = 0.0
-
-            for k in range(num_folds):
-                # get training and validations sets for this fold
-                train_fold_features, train_fold_labels, val_fold_features, val_fold_labels = \
-                        hf.get_data_folds(k, num_folds, reduced_train_features, train_labels)
-
-                # start tensorflow session
-                tf.reset_default_graph()
-                sess = tf.Session()
-
-                model = nnmodel.NeuralNetModel(sess=sess, num_components=num_pca_components,
-                                               channels=channels, num_classes=num_classes, hidden_sizes=hidden_sizes)
-                model.train(train_fold_features, train_fold_labels,
-                            learning_rate=lr, keep_prob=keep_prob,
-                            batch_size=25, num_epochs=20, verbose=verbose)
-
-                val_predictions = model.predict(val_fold_features)
-                avg_val_acc += model.check_accuracy(val_predictions, np.argmax(val_fold_labels, 1))
-
-                # close tensorflow session
-                sess.close()
-
-            avg_val_acc /= num_folds
-
-            if verbose or show_val_acc:
-                print 'ls: %.3e\t\tkeep_prob: %.1f\t\tavg_val_acc: %.4f' % (lr, keep_prob, avg_val_acc)
+    # fold index sets are computed once and shared by all hyperparameter pairs
+    folds = hf.stratified_folds(train_labels, num_folds)
+
+    if search_mode not in ('sequential', 'batched', 'halving'):
+        raise ValueError('Unknown search mode: ' + str(search_mode))
+
+    if search_mode == 'halving':
+        pool = search_pool if search_pool is not None else create_search_pool(search_workers)
+        try:
+            best_lr, best_keep_prob = successive_halving_search(pool, reduced_train_features, train_labels, folds,
+                                                                [(lr, keep_prob) for lr in lrs
+                                                                 for keep_prob in keep_probs],
+                                                                hidden_sizes=hidden_sizes, num_epochs=20,
+                                                                halving_factor=halving_factor, batch_size=batch_size,
+                                                                input_pipeline=input_pipeline, verbose=verbose,
+                                                                show_val_acc=show_val_acc)
+        finally:
+            if search_pool is None:
+                pool.close()
+                pool.join()
+
+    # start tensorflow session, the model is built once and its variables are reset for every trial
+    tf.reset_default_graph()
+    sess = tf.Session(config=hf.session_config(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads))
 
-            if avg_val_acc > best_val_acc:
-                best_val_acc = avg_val_acc
-                best_lr = lr
-                best_keep_prob = keep_prob
+    model = nnmodel.NeuralNetModel(sess=sess, num_components=num_pca_components,
+                                   channels=channels, num_classes=num_classes, hidden_sizes=hidden_sizes)
+    if input_pipeline:
+        # the training data is loaded into the graph once, the trials and the final retrain only set their rows
+        model.load_data(reduced_train_features, train_labels)
+
+    # every (lr, keep_prob, fold) trial of the grid
+    trials = [(lr, keep_prob, k) for lr in lrs for keep_prob in keep_probs for k in range(num_folds)]
+    if search_mode == 'batched':
+        batched_model = nnmodel.BatchedNeuralNetModel(sess=sess, num_models=min(models_per_graph, len(trials)),
+                                                      num_components=num_pca_components, channels=channels,
+                                                      num_classes=num_classes, hidden_sizes=hidden_sizes)
+    sess.graph.finalize()
+
+    if search_mode == 'batched':
+        # trials are trained batched_model.num_models at a time, the last group is padded with copies of its last trial
+        val_accs = {}
+        for start in range(0, len(trials), batched_model.num_models):
+            group = trials[start:start + batched_model.num_models]
+            group += [group[-1]] * (batched_model.num_models - len(group))
+
+            train_masks = np.ones((len(group), reduced_train_features.shape[0]), dtype=bool)
+            for j in range(len(group)):
+                train_masks[j, folds[group[j][2]][1]] = False
+
+            batched_model.reset()
+            batched_model.train(reduced_train_features, train_labels, train_masks,
+                                learning_rates=[trial[0] for trial in group], keep_probs=[trial[1] for trial in group],
+                                batch_size=batch_size, num_epochs=20, verbose=verbose)
+            group_val_accs = batched_model.check_accuracies(reduced_train_features, train_labels, ~train_masks)
+            for trial, val_acc in zip(trials[start:start + batched_model.num_models], group_val_accs):
+                val_accs[trial] = val_acc
+
+    if search_mode != 'halving':
+        for lr in lrs:
+            for keep_prob in keep_probs:
+                avg_val_acc = 0.0
+
+                for k in range(num_folds):
+                    if search_mode == 'batched':
+                        avg_val_acc += val_accs[(lr, keep_prob, k)]
+                        continue
+
+                    train_fold_indices, val_fold_indices = folds[k]
+                    model.reset()
+                    model.train(reduced_train_features, train_labels,
+                                learning_rate=lr, keep_prob=keep_prob,
+                                batch_size=batch_size, num_epochs=20, verbose=verbose, indices=train_fold_indices,
+                                input_pipeline=input_pipeline)
+
+                    val_predictions = model.predict(reduced_train_features, indices=val_fold_indices)
+                    avg_val_acc += model.check_accuracy(val_predictions, np.argmax(train_labels[val_fold_indices], 1))
+
+                avg_val_acc /= num_folds
+
+                if verbose or show_val_acc:
+                    print 'ls: %.3e\t\tkeep_prob: %.1f\t\tavg_val_acc: %.4f' % (lr, keep_prob, avg_val_acc)
+
+                if avg_val_acc > best_val_acc:
+                    best_val_acc = avg_val_acc
+                    best_lr = lr
+                    best_keep_prob = keep_prob
 
     print '\nHyperparameters optimized!'
     print 'Optimal learning rate: %.3e' % best_lr
@@ -138,15 +242,10 @@ def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Ru
     ## TRAIN A MODEL WITH OPTIMAL HYPERPARAMETERS AND TEST IT
     print '\nRetraining model with optimal hyperparameters...'
 
-    # start tensorflow session
-    tf.reset_default_graph()
-    sess = tf.Session()
-
-    model = nnmodel.NeuralNetModel(sess=sess, num_components=num_pca_components,
-                                   channels=channels, num_classes=num_classes, hidden_sizes=hidden_sizes)
+    model.reset()
     model.train(reduced_train_features, train_labels,
                 learning_rate=best_lr, keep_prob=best_keep_prob,
-                batch_size=25, num_epochs=40, verbose=verbose)
+                batch_size=batch_size, num_epochs=40, verbose=verbose, input_pipeline=input_pipeline)
 
     print 'Model trained!'
 
@@ -173,25 +272,141 @@ def run_neural_net_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Ru
     ## ANALYZE FAILED CASES
     print '\n\nTEST ERRORS (# of errors / # of test examples)'
 
-    predicted_vs_truth_count_matrix = np.zeros([len(sports), len(sports)], dtype='int')
-    for i in range(test_predictions.shape[0]):
-        predicted_vs_truth_count_matrix[np.argmax(test_labels, 1)[i], test_predictions[i]] += 1
-
-    for i in range(len(sports)):
-        num_correctly_predicted = predicted_vs_truth_count_matrix[i, i]
-        num_actually_were       = np.sum(predicted_vs_truth_count_matrix[i, :])
-        num_wrongly_predicted   = num_actually_were - num_correctly_predicted
-        print sports[i] + ':\t', num_wrongly_predicted, '/', num_actually_were, '\t', predicted_vs_truth_count_matrix[i,:]
+    ce.evaluate_and_print(sports, test_labels, test_predictions)
 
     if algoSwitch > 1:
         print '\n\nTEST ERRORS FOR NEW PERSON (# of errors / # of test examples)'
 
-        newPerson_predicted_vs_truth_count_matrix = np.zeros([len(sports), len(sports)], dtype='int')
-        for i in range(newPerson_test_predictions.shape[0]):
-            newPerson_predicted_vs_truth_count_matrix[np.argmax(newPerson_test_labels, 1)[i], newPerson_test_predictions[i]] += 1
+        ce.evaluate_and_print(sports, newPerson_test_labels, newPerson_test_predictions)
+
+
+def create_search_pool(num_workers=None):
+    """
+    Creates the pool of processes of successive_halving_search. The workers are forked, and tensorflow is not fork
+    safe, so the pool has to be created before this process starts a tensorflow session (e.g. at the start of a run)
+    and can then be reused by every search of the run.
+    :param num_workers: Number of processes (None for one per core)
+    :return: the pool
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    return multiprocessing.Pool(num_workers, initializer=init_search_worker,
+                                initargs=(max(1, multiprocessing.cpu_count() / num_workers),))
 
-        for i in range(len(sports)):
-            num_correctly_predicted = newPerson_predicted_vs_truth_count_matrix[i, i]
-            num_actually_were = np.sum(newPerson_predicted_vs_truth_count_matrix[i, :])
-            num_wrongly_predicted = num_actually_were - num_correctly_predicted
-            print sports[i] + ':\t', num_wrongly_predicted, '/', num_actually_were, '\t', newPerson_predicted_vs_truth_count_matrix[i, :]
+
+def successive_halving_search(pool, features, labels, folds, candidates, hidden_sizes=[1024, 1024], num_epochs=20,
+                              halving_factor=3, batch_size=25, input_pipeline=False, verbose=False,
+                              show_val_acc=True):
+    """
+    Successive halving search over (learning rate, keep probability) pairs. Every round trains all remaining pairs on
+    every fold, for halving_factor times as many epochs as the round before, and keeps the best 1 / halving_factor of
+    them by average validation accuracy. The last round trains for num_epochs epochs. The fold trials of a round are
+    spread over the processes of pool, each with its own tensorflow session. The data of the search is handed to the
+    workers through a temporary file, which every worker loads once.
+    :param pool: pool made by create_search_pool
+    :param features: training features (samples x components x channels)
+    :param labels: one-hot training labels
+    :param folds: list of (train indices, validation indices) pairs
+    :param candidates: list of (learning rate, keep probability) pairs
+    :param hidden_sizes: list of sizes for the hidden layers
+    :param num_epochs: Number of epochs of the last round
+    :param halving_factor: see run_neural_net_classifier
+    :param batch_size: Minibatch size of the training steps
+    :param input_pipeline: see run_neural_net_classifier
+    :param verbose: Set True to display the rounds
+    :param show_val_acc: Set True to show average validation accuracies of every round
+    :return: best learning rate and keep probability
+    """
+    # number of pairs trained in each round, down to at most halving_factor pairs in the last round
+    round_sizes = [len(candidates)]
+    while round_sizes[-1] > halving_factor:
+        round_sizes.append(int(np.ceil(float(round_sizes[-1]) / halving_factor)))
+
+    fileHandle, searchFile = tempfile.mkstemp(suffix='.npz')
+    os.close(fileHandle)
+    folds_data = {}
+    for k in range(len(folds)):
+        folds_data['train_fold_%d' % k], folds_data['val_fold_%d' % k] = folds[k]
+    np.savez(searchFile, features=features, labels=labels, **folds_data)
+    # the search number tells the workers apart searches whose temporary files happen to get the same name
+    search = (next(_search_numbers), searchFile, len(folds), hidden_sizes,
+              dict(batch_size=batch_size, input_pipeline=input_pipeline))
+
+    try:
+        for r in range(len(round_sizes)):
+            round_epochs = max(1, int(round(float(num_epochs) / halving_factor ** (len(round_sizes) - 1 - r))))
+            if verbose or show_val_acc:
+                print '%sRound %d: %d pairs, %d epochs' % ('\n' if r > 0 else '', r + 1, len(candidates), round_epochs)
+
+            trials = [(search, lr, keep_prob, k, round_epochs)
+                      for lr, keep_prob in candidates for k in range(len(folds))]
+            val_accs = np.array(pool.map(run_search_trial, trials, chunksize=1)).reshape((len(candidates), len(folds)))
+            avg_val_accs = np.mean(val_accs, 1)
+
+            if verbose or show_val_acc:
+                for (lr, keep_prob), avg_val_acc in zip(candidates, avg_val_accs):
+                    print 'ls: %.3e\t\tkeep_prob: %.1f\t\tavg_val_acc: %.4f' % (lr, keep_prob, avg_val_acc)
+
+            # stable sort, so that ties keep the order of the grid (as in the sequential search)
+            order = np.argsort(-avg_val_accs, kind='mergesort')
+            if r + 1 < len(round_sizes):
+                candidates = [candidates[i] for i in order[:round_sizes[r + 1]]]
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    finally:
+        os.remove(searchFile)
+
+    return candidates[order[0]]
+
+
+# numbers of the successive halving searches of this process
+_search_numbers = itertools.count()
+
+# thread count, and model and data of the current search, of a successive halving search worker process
+_search_worker = {}
+
+
+def init_search_worker(num_threads):
+    """
+    Pool initializer: only remembers the thread count, tensorflow is started by the first trial of a search.
+    """
+    _search_worker['num_threads'] = num_threads
+
+
+def run_search_trial(args):
+    """
+    Pool worker: trains a model on one fold and returns its validation accuracy. The data of the search is loaded and
+    the model built on the first trial of each search the worker gets.
+    :param args: tuple of search (number, data file, number of folds, hidden sizes and training options), learning rate,
+                 keep probability, fold index and number of epochs
+    """
+    search, lr, keep_prob, k, num_epochs = args
+    _, searchFile, num_folds, hidden_sizes, train_options = search
+
+    if _search_worker.get('search') != search:
+        if 'model' in _search_worker:
+            _search_worker['model'].sess.close()
+        with np.load(searchFile) as data:
+            features, labels = data['features'], data['labels']
+            folds = [(data['train_fold_%d' % f], data['val_fold_%d' % f]) for f in range(num_folds)]
+
+        tf.reset_default_graph()
+        sess = tf.Session(config=hf.session_config(intra_op_threads=_search_worker['num_threads'], inter_op_threads=1))
+        model = nnmodel.NeuralNetModel(sess=sess, num_components=features.shape[1], channels=features.shape[2],
+                                       num_classes=labels.shape[1], hidden_sizes=hidden_sizes)
+        sess.graph.finalize()
+        if train_options['input_pipeline']:
+            model.load_data(features, labels)
+        _search_worker.update(search=search, model=model, features=features, labels=labels, folds=folds)
+
+    model, features, labels = _search_worker['model'], _search_worker['features'], _search_worker['labels']
+    train_fold_indices, val_fold_indices = _search_worker['folds'][k]
+
+    model.reset()
+    model.train(features, labels, learning_rate=lr, keep_prob=keep_prob, num_epochs=num_epochs, verbose=False,
+                indices=train_fold_indices, **train_options)
+
+    val_predictions = model.predict(features, indices=val_fold_indices)
+    return model.check_accuracy(val_predictions, np.argmax(labels[val_fold_indices], 1))
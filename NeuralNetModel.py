@@ -6,9 +6,32 @@ class NeuralNetModel:
     def __init__(self, sess, num_components=100, channels=6, num_classes=5, hidden_sizes=[1024, 1024]):
         self.sess = sess
 
-        # placeholders for input data and hyperparameters
-        self.x = tf.placeholder(tf.float32, shape=[None, num_components, channels])
-        self.y = tf.placeholder(tf.float32, shape=[None, num_classes])
+        # training data of the input pipeline (see load_data and train), which reset leaves in place
+        # every train call sets the rows it trains on in data_indices, every epoch shuffles their order, and batches
+        # are gathered in the graph, so that only the batch boundaries are fed on each step
+        self.data_features = tf.Variable(tf.zeros([0, num_components, channels]), trainable=False, validate_shape=False)
+        self.data_labels = tf.Variable(tf.zeros([0, num_classes]), trainable=False, validate_shape=False)
+        self.data_indices = tf.Variable(tf.zeros([0], dtype=tf.int32), trainable=False, validate_shape=False)
+        self.num_data_rows = 0
+        self.new_features = tf.placeholder(tf.float32, shape=[None, num_components, channels])
+        self.new_labels = tf.placeholder(tf.float32, shape=[None, num_classes])
+        self.new_indices = tf.placeholder(tf.int32, shape=[None])
+        self.assign_data = [tf.assign(self.data_features, self.new_features, validate_shape=False),
+                            tf.assign(self.data_labels, self.new_labels, validate_shape=False)]
+        self.assign_indices = tf.assign(self.data_indices, self.new_indices, validate_shape=False)
+        self.sess.run(tf.variables_initializer([self.data_features, self.data_labels, self.data_indices]))
+        existing_variables = set(tf.global_variables())
+
+        self.shuffle_data = tf.assign(self.data_indices, tf.random_shuffle(self.data_indices), validate_shape=False)
+        self.batch_start = tf.placeholder(tf.int32, shape=[])
+        self.batch_end = tf.placeholder(tf.int32, shape=[])
+        batch_indices = tf.slice(self.data_indices, tf.reshape(self.batch_start, [1]),
+                                 tf.reshape(self.batch_end - self.batch_start, [1]))
+
+        # placeholders for input data and hyperparameters (input data defaults to the input pipeline's batch)
+        self.x = tf.placeholder_with_default(tf.gather(self.data_features, batch_indices),
+                                             shape=[None, num_components, channels])
+        self.y = tf.placeholder_with_default(tf.gather(self.data_labels, batch_indices), shape=[None, num_classes])
         self.keep_prob = tf.placeholder(tf.float32)
         self.learning_rate = tf.placeholder(tf.float32)
 
@@ -32,63 +55,224 @@ class NeuralNetModel:
 
         self.cross_entropy = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(self.y_out, self.y))
         self.train_step = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.cross_entropy)
+        self.probabilities = tf.nn.softmax(self.y_out)
         self.predictions = tf.argmax(self.y_out, 1)
         self.correct_prediction = tf.equal(self.predictions, tf.argmax(self.y, 1))
         self.accuracy = tf.reduce_mean(tf.cast(self.correct_prediction, tf.float32))
-        self.sess.run(tf.global_variables_initializer())
+        # initializes only this model's variables (and optimizer slots), other models may share the graph
+        self.init = tf.variables_initializer([v for v in tf.global_variables() if v not in existing_variables])
+        self.sess.run(self.init)
+
+    def reset(self):
+        # draws new initial weights and clears the optimizer state, so that the graph can be reused for a new model
+        self.sess.run(self.init)
+
+    def load_data(self, features, labels):
+        # loads features and labels (which may be memory-mapped) into the graph for the input pipeline of train, once
+        # for all the models trained on them
+        self.sess.run(self.assign_data, feed_dict={self.new_features: features, self.new_labels: labels})
+        self.num_data_rows = features.shape[0]
 
-    def train(self, features, labels, learning_rate=1e-2, keep_prob=0.5, batch_size=25, num_epochs=20, verbose=True):
+    def train(self, features, labels, learning_rate=1e-2, keep_prob=0.5, batch_size=25, num_epochs=20, verbose=True,
+              indices=None, input_pipeline=False, shuffle=True):
         # tensorflow neural net training iterations
-        iters_per_epoch = np.ceil(float(features.shape[0]) / batch_size).astype(int)
+        # if indices is given, only those rows of features and labels are trained on (gathered batch by batch)
+        # with input_pipeline, the batches are gathered in the graph from the data given to load_data (features and
+        # labels are not read), in an order that is shuffled every epoch if shuffle is set; otherwise every batch is
+        # sliced in numpy and fed, in the order of the rows
+        if input_pipeline:
+            if indices is None:
+                indices = np.arange(self.num_data_rows)
+            self.sess.run(self.assign_indices, feed_dict={self.new_indices: indices})
+
+        num_samples = features.shape[0] if indices is None else len(indices)
+        iters_per_epoch = np.ceil(float(num_samples) / batch_size).astype(int)
 
         for i in range(num_epochs * iters_per_epoch):
             start_index = (i%iters_per_epoch)*batch_size
             end_index = ((i%iters_per_epoch)+1)*batch_size
-            if end_index > features.shape[0]:
-                end_index = features.shape[0]
+            if end_index > num_samples:
+                end_index = num_samples
 
-            features_batch = features[start_index:end_index]
-            labels_batch = labels[start_index:end_index]
+            if input_pipeline:
+                if shuffle and i % iters_per_epoch == 0:
+                    self.sess.run(self.shuffle_data)
+                feed_dict = {self.batch_start: start_index, self.batch_end: end_index}
+            elif indices is None:
+                feed_dict = {self.x: features[start_index:end_index], self.y: labels[start_index:end_index]}
+            else:
+                feed_dict = {self.x: features[indices[start_index:end_index]],
+                             self.y: labels[indices[start_index:end_index]]}
 
             if i % 50 == 0 and verbose:
+                feed_dict[self.keep_prob] = 1.0
                 with self.sess.as_default():
-                    train_accuracy = self.accuracy.eval(feed_dict={self.x: features_batch, self.y: labels_batch,
-                                                                   self.keep_prob: 1.0})
+                    train_accuracy = self.accuracy.eval(feed_dict=feed_dict)
                     print("step %d, training accuracy: %.4f" % (i, train_accuracy))
 
+            feed_dict[self.keep_prob] = keep_prob
+            feed_dict[self.learning_rate] = learning_rate
             with self.sess.as_default():
-                self.train_step.run(feed_dict={self.x: features_batch, self.y: labels_batch,
-                                               self.keep_prob: keep_prob, self.learning_rate: learning_rate})
+                self.train_step.run(feed_dict=feed_dict)
 
-    def predict(self, features, batch_size=50):
-        # return predicted labels for given input features
-        y_pred = np.array([])
+    def predict(self, features, batch_size=1000, indices=None):
+        # return predicted labels for given input features (only for the rows in indices, if given)
+        return self.predict_all(features, batch_size=batch_size, indices=indices)['labels']
 
-        for i in range(np.ceil(float(features.shape[0]) / batch_size).astype(int)):
-            start_index = i * batch_size
-            end_index = (i + 1) * batch_size
-            if end_index > features.shape[0]:
-                end_index = features.shape[0]
+    def predict_all(self, features, batch_size=1000, indices=None):
+        # return predicted labels, class probabilities and logits for given input features (only for the rows in
+        # indices, if given), in a dict with keys 'labels', 'probabilities' and 'logits'
+        num_samples = features.shape[0] if indices is None else len(indices)
+        num_classes = self.y_out.get_shape().as_list()[1]
+        outputs = {'labels': np.zeros(num_samples, dtype=int),
+                   'probabilities': np.zeros((num_samples, num_classes), dtype=np.float32),
+                   'logits': np.zeros((num_samples, num_classes), dtype=np.float32)}
 
-            features_batch = features[start_index:end_index]
-            with self.sess.as_default():
-                y_pred = np.append(y_pred, self.predictions.eval(feed_dict={self.x: features_batch, self.keep_prob: 1.0}))
+        for start_index in range(0, num_samples, batch_size):
+            end_index = min(start_index + batch_size, num_samples)
 
-        return y_pred.astype(int)
+            if indices is None:
+                features_batch = features[start_index:end_index]
+            else:
+                features_batch = features[indices[start_index:end_index]]
+            (outputs['labels'][start_index:end_index], outputs['probabilities'][start_index:end_index],
+             outputs['logits'][start_index:end_index]) = self.sess.run(
+                [self.predictions, self.probabilities, self.y_out],
+                feed_dict={self.x: features_batch, self.keep_prob: 1.0})
+
+        return outputs
 
     @staticmethod
-    def check_accuracy(predicted_labels, true_labels, batch_size=50):
-        # calculates accuracy in batches to save memory consumption
+    def check_accuracy(predicted_labels, true_labels):
+        # fraction of predicted labels equal to the true labels
         assert predicted_labels.shape == true_labels.shape
+        return np.mean(np.equal(predicted_labels, true_labels))
+
+
+class BatchedNeuralNetModel:
+    # num_models independent copies of NeuralNetModel that are trained side by side with batched matmuls
+    # the weights of all models are stacked into rank-3 tensors and every model has its own learning rate, dropout
+    # keep probability and mask of the rows it trains on (e.g. the training rows of its fold)
+    # Adam and dropout are implemented here, because tensorflow's take a single learning rate and keep probability
+    def __init__(self, sess, num_models, num_components=100, channels=6, num_classes=5, hidden_sizes=[1024, 1024],
+                 beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.sess = sess
+        self.num_models = num_models
+        existing_variables = set(tf.global_variables())
+
+        # placeholders for input data (one minibatch per model) and per-model hyperparameters
+        # row_weights is 1 for the rows of each minibatch that the model trains on and 0 for padding rows, which
+        # make the minibatches of all models the same length
+        self.x = tf.placeholder(tf.float32, shape=[num_models, None, num_components, channels])
+        self.y = tf.placeholder(tf.float32, shape=[num_models, None, num_classes])
+        self.row_weights = tf.placeholder(tf.float32, shape=[num_models, None])
+        self.keep_prob = tf.placeholder(tf.float32, shape=[num_models])
+        self.learning_rate = tf.placeholder(tf.float32, shape=[num_models])
+
+        self.reshaped_x = tf.reshape(self.x, [num_models, -1, num_components * channels])
+        keep_prob = tf.reshape(self.keep_prob, [num_models, 1, 1])
+
+        self.W_fc1 = hf.weight_var([num_models, num_components * channels, hidden_sizes[0]])
+        self.b_fc1 = hf.bias_var([num_models, 1, hidden_sizes[0]])
+        self.h_fc1 = tf.nn.relu(hf.batch_matmul(self.reshaped_x, self.W_fc1) + self.b_fc1)
+
+        self.h_fc1_drop = self.h_fc1 * tf.floor(keep_prob + tf.random_uniform(tf.shape(self.h_fc1))) / keep_prob
+
+        self.W_fc2 = hf.weight_var([num_models, hidden_sizes[0], hidden_sizes[1]])
+        self.b_fc2 = hf.bias_var([num_models, 1, hidden_sizes[1]])
+        self.h_fc2 = hf.batch_matmul(self.h_fc1_drop, self.W_fc2) + self.b_fc2
+
+        self.h_fc2_drop = self.h_fc2 * tf.floor(keep_prob + tf.random_uniform(tf.shape(self.h_fc2))) / keep_prob
+
+        self.W_fc3 = hf.weight_var([num_models, hidden_sizes[1], num_classes])
+        self.b_fc3 = hf.bias_var([num_models, 1, num_classes])
+        self.y_out = hf.batch_matmul(self.h_fc2_drop, self.W_fc3) + self.b_fc3
+
+        # the models are independent, so minimizing the sum of their losses trains each of them on its own loss, the
+        # mean over the rows of its minibatch
+        num_rows = tf.reduce_sum(self.row_weights, 1)
+        self.cross_entropy = tf.reduce_sum(self.row_weights * tf.reshape(tf.nn.softmax_cross_entropy_with_logits(
+            tf.reshape(self.y_out, [-1, num_classes]), tf.reshape(self.y, [-1, num_classes])), [num_models, -1]),
+            1) / tf.maximum(num_rows, 1)
+
+        # Adam with a learning rate and a step count per model, shaped to broadcast over the stacked weights
+        # models without rows in a minibatch (they have run out of rows for the epoch) skip the step altogether
+        weights = [self.W_fc1, self.b_fc1, self.W_fc2, self.b_fc2, self.W_fc3, self.b_fc3]
+        gradients = tf.gradients(tf.reduce_sum(self.cross_entropy), weights)
+
+        active = tf.reshape(tf.cast(num_rows > 0, tf.float32), [num_models, 1, 1])
+        learning_rates = tf.Variable(tf.zeros([num_models, 1, 1]))
+        self.set_learning_rates = tf.assign(learning_rates, tf.reshape(self.learning_rate, [num_models, 1, 1]))
+        steps = tf.Variable(tf.zeros([num_models, 1, 1]))
+        new_steps = tf.maximum(tf.assign_add(steps, active), 1)
+        step_sizes = active * learning_rates * tf.sqrt(1 - tf.pow(beta2, new_steps)) / (1 - tf.pow(beta1, new_steps))
+
+        # the weights are updated in place, so no update may start before all gradients are computed (backpropagation
+        # reads the weights of the later layers)
+        slots = [(tf.Variable(tf.zeros(weight.get_shape().as_list())),
+                  tf.Variable(tf.zeros(weight.get_shape().as_list()))) for weight in weights]
+        updates = []
+        with tf.control_dependencies(gradients):
+            for weight, gradient, (m, v) in zip(weights, gradients, slots):
+                new_m = tf.assign_sub(m, active * (1 - beta1) * (m - gradient))
+                new_v = tf.assign_sub(v, active * (1 - beta2) * (v - tf.square(gradient)))
+                updates.append(tf.assign_sub(weight, step_sizes * new_m / (tf.sqrt(new_v) + epsilon)))
+        self.train_step = tf.group(*updates)
+
+        self.predictions = tf.argmax(self.y_out, 2)
+        self.correct_prediction = tf.equal(self.predictions, tf.argmax(self.y, 2))
+        self.accuracies = tf.reduce_sum(self.row_weights * tf.cast(self.correct_prediction, tf.float32),
+                                        1) / tf.maximum(num_rows, 1)
+        self.init = tf.variables_initializer([v for v in tf.global_variables() if v not in existing_variables])
+        self.sess.run(self.init)
+
+    def reset(self):
+        # draws new initial weights and clears the optimizer state of all models
+        self.sess.run(self.init)
+
+    def train(self, features, labels, masks, learning_rates, keep_probs, batch_size=25, num_epochs=20, verbose=True):
+        # tensorflow neural net training iterations of all models at once
+        # masks is a (num_models x samples) boolean array of the rows each model trains on; every model walks through
+        # its rows in order, batch_size of them per step, as NeuralNetModel.train does without input_pipeline
+        # minibatches of models with fewer rows than the others are padded (with rows that do not count), and once a
+        # model is through its rows it skips the remaining steps of the epoch, so that every model takes the same
+        # steps as on its own
+        model_rows = [np.flatnonzero(mask) for mask in masks]
+        assert min(len(rows) for rows in model_rows) > 0
+        iters_per_epoch = np.ceil(float(max(len(rows) for rows in model_rows)) / batch_size).astype(int)
+
+        self.sess.run(self.set_learning_rates, feed_dict={self.learning_rate: learning_rates})
+
+        for i in range(num_epochs * iters_per_epoch):
+            batch_positions = np.arange((i%iters_per_epoch)*batch_size, ((i%iters_per_epoch)+1)*batch_size)
+            batch_indices = np.array([rows[np.where(batch_positions < len(rows), batch_positions, 0)]
+                                      for rows in model_rows])
+            row_weights = np.array([batch_positions < len(rows) for rows in model_rows], dtype=np.float32)
+            feed_dict = {self.x: features[batch_indices], self.y: labels[batch_indices], self.row_weights: row_weights}
+
+            if i % 50 == 0 and verbose:
+                feed_dict[self.keep_prob] = np.ones(self.num_models)
+                train_accuracies = self.sess.run(self.accuracies, feed_dict=feed_dict)
+                print("step %d, mean training accuracy: %.4f" % (i, np.mean(train_accuracies)))
 
-        y_accs = np.array([])
+            feed_dict[self.keep_prob] = keep_probs
+            self.sess.run(self.train_step, feed_dict=feed_dict)
 
-        for i in range(np.ceil(float(predicted_labels.shape[0]) / batch_size).astype(int)):
-            start_index = i*batch_size
-            end_index = (i+1)*batch_size
-            if end_index > predicted_labels.shape[0]:
-                end_index = predicted_labels.shape[0]
+    def check_accuracies(self, features, labels, masks, batch_size=50):
+        # return the accuracy of every model on its masked rows (e.g. the validation rows of its fold)
+        model_rows = [np.flatnonzero(mask) for mask in masks]
+        num_rows = max(len(rows) for rows in model_rows)
+        correct = np.zeros(self.num_models)
 
-            y_accs = np.append(y_accs, np.equal(predicted_labels[start_index:end_index], true_labels[start_index:end_index]))
+        for start_index in range(0, num_rows, batch_size):
+            # rows of models with fewer rows are padded with their first row, and not counted
+            batch_positions = np.arange(start_index, min(start_index + batch_size, num_rows))
+            batch_indices = np.array([rows[np.where(batch_positions < len(rows), batch_positions, 0)]
+                                      for rows in model_rows])
+            batch_correct = self.sess.run(self.correct_prediction, feed_dict={
+                self.x: features[batch_indices], self.y: labels[batch_indices],
+                self.keep_prob: np.ones(self.num_models)})
+            for k in range(self.num_models):
+                correct[k] += np.sum(batch_correct[k][batch_positions < len(model_rows[k])])
 
-        return np.mean(y_accs)
+        return correct / np.array([len(rows) for rows in model_rows])
@@ -1,43 +1,77 @@
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+import itertools
 import numpy as np
 from sklearn.ensemble import  RandomForestClassifier
 from sklearn.pipeline import Pipeline
-from sklearn.decomposition import PCA
 from sklearn.grid_search import GridSearchCV
 import ClassifierHelperFunctions as hf
+import ClassifierEvaluation as ce
 
 
 def run_random_forest_classifier(sports=['Badminton', 'Basketball', 'Foosball', 'Running', 'Skating', 'Walking'],
                                  featuresFile='../Data/featuresFinal.csv',
                                  labelsFile='../Data/labelsFinal.csv',
+                                 newPersonFeaturesFile='../Data/newPersonFeaturesFinal.csv',
+                                 newPersonLabelsFile='../Data/newPersonLabelsFinal.csv',
+                                 secondaryFeaturesFile='../Data/secondaryFeaturesFinal.csv',
+                                 newPersonSecondaryFeaturesFile='../Data/newPersonSecondaryFeaturesFinal.csv',
                                  freqDims=150,
                                  timeDims=13,
                                  channels=6,
                                  num_pca_components=200,
                                  pca_whiten=True,
-                                 algoSwitch=0):
-    print '\nLoading data...'
+                                 pca_fit_components=0,
+                                 pca_backend='auto',
+                                 algoSwitch=0,
+                                 split_seed=None,
+                                 featureSet='fft',
+                                 search_mode='grid'):
+    # featureSet selects what the forest is trained on: 'fft' for the PCA of the FFT features, 'statistical' for the
+    # statistical features of the secondary features files (no PCA, so much cheaper to load, train and evaluate), or
+    # 'both' for the two side by side
+    # search_mode is 'grid' for a GridSearchCV over tuned_parameters, or 'halving' for successive_halving_search
+    if featureSet not in ('fft', 'statistical', 'both'):
+        raise ValueError('Unknown feature set: ' + str(featureSet))
+    if search_mode not in ('grid', 'halving'):
+        raise ValueError('Unknown search mode: ' + str(search_mode))
 
-    data = hf.load_data(featuresFile, labelsFile)
+    print '\nLoading data...'
 
-    train_features = data['train_features'].reshape((-1, freqDims * timeDims, channels))
-    train_labels   = data['train_labels']
-    test_features  = data['test_features'].reshape((-1, freqDims * timeDims, channels))
-    test_labels    = data['test_labels']
+    # the (possibly memory-mapped) features are only read by the PCA stage, through the indices of each set
+    # the split only depends on the labels and split_seed, so both feature files get the same split
+    data = hf.load_data(secondaryFeaturesFile if featureSet == 'statistical' else featuresFile, labelsFile,
+                        seed=split_seed, indicesOnly=True)
+
+    train_indices = data['train_indices']
+    train_labels  = data['labels'][train_indices]
+    test_indices  = data['test_indices']
+    test_labels   = data['labels'][test_indices]
+    if featureSet != 'statistical':
+        features = data['features'].reshape((-1, freqDims * timeDims, channels))
+    if featureSet != 'fft':
+        secondary_features = data['features'] if featureSet == 'statistical' else \
+            hf.load_array(secondaryFeaturesFile, 'float')
 
     if algoSwitch > 1:
-        newPerson_data = hf.load_data('../Data/newPersonFeaturesFinal.csv', '../Data/newPersonLabelsFinal.csv',
-                                      newPerson=True)
-        newPerson_test_features = newPerson_data['test_features'].reshape((-1, freqDims * timeDims, channels))
-        newPerson_test_labels = newPerson_data['test_labels']
-
+        newPerson_data = hf.load_data(newPersonSecondaryFeaturesFile if featureSet == 'statistical' else
+                                      newPersonFeaturesFile, newPersonLabelsFile, newPerson=True, seed=split_seed,
+                                      indicesOnly=True)
+        newPerson_test_indices = newPerson_data['test_indices']
+        newPerson_test_labels = newPerson_data['labels'][newPerson_test_indices]
+        if featureSet != 'statistical':
+            newPerson_features = newPerson_data['features'].reshape((-1, freqDims * timeDims, channels))
+        if featureSet != 'fft':
+            newPerson_secondary_features = newPerson_data['features'] if featureSet == 'statistical' else \
+                hf.load_array(newPersonSecondaryFeaturesFile, 'float')
+
+    sample_shape = features.shape[1:] if featureSet != 'statistical' else secondary_features.shape[1:]
     print 'Data loaded!'
-    print 'Training set:  ', train_features.shape
-    print 'Test set:      ', test_features.shape
+    print 'Training set:  ', (len(train_indices),) + sample_shape
+    print 'Test set:      ', (len(test_indices),) + sample_shape
     if algoSwitch > 1:
-        print 'New person test set:', newPerson_test_features.shape[0]
+        print 'New person test set:', len(newPerson_test_indices)
 
     random_forest=RandomForestClassifier()
     tuned_parameters = [{'classifier__min_samples_split' : [5,10],
@@ -45,67 +79,130 @@ def run_random_forest_classifier(sports=['Badminton', 'Basketball', 'Foosball',
                          'classifier__n_estimators' : [15,25]}] #prepared the range of parameters to search over for GridSearchCV
 
 
-    print '\nReducing dimensionality using PCA...'
+    if featureSet != 'statistical':
+        print '\nReducing dimensionality using PCA...'
 
-    if num_pca_components > freqDims*timeDims:
-        num_pca_components = freqDims*timeDims
+        if num_pca_components > freqDims*timeDims:
+            num_pca_components = freqDims*timeDims
 
-    reduced_train_features = np.zeros((train_features.shape[0], num_pca_components, channels))
-    reduced_test_features = np.zeros((test_features.shape[0], num_pca_components, channels))
-    if algoSwitch > 1:
-        reduced_newPerson_test_features = np.zeros((newPerson_test_features.shape[0], num_pca_components, channels))
-
-    for c in range(channels):
-        pca = PCA(n_components=num_pca_components, whiten=pca_whiten)
-        reduced_train_features[:,:,c] = pca.fit_transform(train_features[:,:,c])
-        reduced_test_features[:,:,c]  = pca.transform(test_features[:,:,c])
+        # the PCAs are fitted once at the largest number of components the caller asks for, and reused for all
+        # smaller ones (and by the other classifier) while the training features stay the same
+        pcas = hf.fit_channel_pcas(features, min(max(num_pca_components, pca_fit_components), freqDims*timeDims),
+                                   backend=pca_backend, indices=train_indices)
+        reduced_train_features = hf.project_channels(features, pcas, num_pca_components, whiten=pca_whiten,
+                                                     indices=train_indices)
+        reduced_test_features = hf.project_channels(features, pcas, num_pca_components, whiten=pca_whiten,
+                                                    indices=test_indices)
         if algoSwitch > 1:
-            reduced_newPerson_test_features[:, :, c] = pca.transform(newPerson_test_features[:, :, c])
+            reduced_newPerson_test_features = hf.project_channels(newPerson_features, pcas, num_pca_components,
+                                                                  whiten=pca_whiten, indices=newPerson_test_indices)
 
-    print 'Dimensionality reduced!'
-    print 'Old feature dimensions:', train_features.shape[1]*train_features.shape[2]
-    print 'New feature dimensions:', reduced_train_features.shape[1]*reduced_train_features.shape[2]
+        print 'Dimensionality reduced!'
+        print 'Old feature dimensions:', features.shape[1]*features.shape[2]
+        print 'New feature dimensions:', reduced_train_features.shape[1]*reduced_train_features.shape[2]
 
     pipeline = Pipeline([("classifier", random_forest)])
-    pipeline_grid = GridSearchCV(pipeline, tuned_parameters, cv = 5, n_jobs=-1)
+    folds = hf.stratified_folds(train_labels, 5)
     train_labels   = np.argmax(train_labels, 1)
 
-    reduced_train_features=reduced_train_features.reshape((reduced_train_features.shape[0],-1))
-    reduced_test_features=reduced_test_features.reshape((reduced_test_features.shape[0],-1))
-    if algoSwitch > 1:
-        reduced_newPerson_test_features = reduced_newPerson_test_features.reshape((reduced_newPerson_test_features.shape[0], -1))
-
-    pipeline_grid.fit(reduced_train_features,train_labels)
-    print pipeline_grid.best_params_
-    predictions=pipeline_grid.predict(reduced_test_features)
+    # rows of the matrices the forest is trained and tested on: flattened PCA features, statistical features or both
+    train_blocks, test_blocks, newPerson_test_blocks = [], [], []
+    if featureSet != 'statistical':
+        train_blocks.append(reduced_train_features.reshape((reduced_train_features.shape[0],-1)))
+        test_blocks.append(reduced_test_features.reshape((reduced_test_features.shape[0],-1)))
+        if algoSwitch > 1:
+            newPerson_test_blocks.append(reduced_newPerson_test_features.reshape((reduced_newPerson_test_features.shape[0], -1)))
+    if featureSet != 'fft':
+        train_blocks.append(finite_features(secondary_features[train_indices]))
+        test_blocks.append(finite_features(secondary_features[test_indices]))
+        if algoSwitch > 1:
+            newPerson_test_blocks.append(finite_features(newPerson_secondary_features[newPerson_test_indices]))
+
+    if search_mode == 'halving':
+        best_params = successive_halving_search(np.hstack(train_blocks), train_labels, folds, tuned_parameters[0])
+        print best_params
+        pipeline_grid = pipeline.set_params(**best_params)
+        pipeline_grid.set_params(classifier__n_jobs=-1)
+    else:
+        pipeline_grid = GridSearchCV(pipeline, tuned_parameters, cv = 5, n_jobs=-1)
+
+    pipeline_grid.fit(np.hstack(train_blocks),train_labels)
+    if search_mode == 'grid':
+        print pipeline_grid.best_params_
+    predictions=pipeline_grid.predict(np.hstack(test_blocks))
     print predictions.shape
 
     if algoSwitch > 1:
-        newPerson_predictions = pipeline_grid.predict(reduced_newPerson_test_features)
+        newPerson_predictions = pipeline_grid.predict(np.hstack(newPerson_test_blocks))
         print newPerson_predictions.shape
 
 
     print '\nTEST ERRORS (# of errors / # of test examples)'
 
-    predicted_vs_truth_count_matrix = np.zeros([len(sports), len(sports)], dtype='int')
-    for i in range(predictions.shape[0]):
-        predicted_vs_truth_count_matrix[np.argmax(test_labels, 1)[i], predictions[i]] += 1
-
-    for i in range(len(sports)):
-        num_correctly_predicted = predicted_vs_truth_count_matrix[i,i]
-        num_actually_were = np.sum(predicted_vs_truth_count_matrix[i, :])
-        num_wrongly_predicted = num_actually_were - num_correctly_predicted
-        print sports[i] + ':\t', num_wrongly_predicted, '/', num_actually_were, '\t', predicted_vs_truth_count_matrix[i,:]
+    ce.evaluate_and_print(sports, test_labels, predictions)
 
     if algoSwitch > 1:
         print '\n\nTEST ERRORS FOR NEW PERSON (# of errors / # of test examples)'
 
-        newPerson_predicted_vs_truth_count_matrix = np.zeros([len(sports), len(sports)], dtype='int')
-        for i in range(newPerson_predictions.shape[0]):
-            newPerson_predicted_vs_truth_count_matrix[np.argmax(newPerson_test_labels, 1)[i], newPerson_predictions[i]] += 1
-
-        for i in range(len(sports)):
-            num_correctly_predicted = newPerson_predicted_vs_truth_count_matrix[i, i]
-            num_actually_were = np.sum(newPerson_predicted_vs_truth_count_matrix[i, :])
-            num_wrongly_predicted = num_actually_were - num_correctly_predicted
-            print sports[i] + ':\t', num_wrongly_predicted, '/', num_actually_were, '\t', newPerson_predicted_vs_truth_count_matrix[i, :]
+        ce.evaluate_and_print(sports, newPerson_test_labels, newPerson_predictions)
+
+
+def finite_features(features):
+    """
+    Replaces the non-finite statistical features by 0. The statistics and correlations of a constant window (zero
+    standard deviation) are NaN, and the coefficient of variation of a window with zero mean is infinite, which the
+    forest rejects (it works in float32, where even the largest float64 overflows to infinity).
+    :param features: statistical features (samples x features)
+    :return: float copy of features with every NaN and infinite entry set to 0
+    """
+    features = np.array(features, dtype=float)
+    features[~np.isfinite(features)] = 0
+    return features
+
+
+def successive_halving_search(features, labels, folds, tuned_parameters, halving_factor=2):
+    """
+    Successive halving search over the random forest parameters in tuned_parameters (a GridSearchCV parameter grid
+    with 'classifier__' keys). The forests of every other parameter combination are grown fold by fold through the
+    n_estimators values in increasing order, adding trees to the forests of the previous value (warm start), and only
+    the best 1 / halving_factor of the combinations, by average validation accuracy, are grown further.
+    :param features: training features (samples x features)
+    :param labels: training labels (class indices)
+    :param folds: list of (train indices, validation indices) pairs
+    :param tuned_parameters: dict from parameter name to the list of its values
+    :param halving_factor: Fraction (1 / halving_factor) of parameter combinations kept after each n_estimators value
+    :return: best parameters, with the keys of tuned_parameters
+    """
+    tree_counts = sorted(tuned_parameters['classifier__n_estimators'])
+    keys = sorted(key for key in tuned_parameters if key != 'classifier__n_estimators')
+    candidates = list(itertools.product(*[tuned_parameters[key] for key in keys]))
+
+    forests = {}
+    scores = []
+    for r, n_estimators in enumerate(tree_counts):
+        candidate_scores = []
+        for candidate in candidates:
+            fold_scores = []
+            for k, (train_fold_indices, val_fold_indices) in enumerate(folds):
+                if (candidate, k) not in forests:
+                    forests[(candidate, k)] = RandomForestClassifier(warm_start=True, n_jobs=-1, **dict(
+                        (key[len('classifier__'):], value) for key, value in zip(keys, candidate)))
+                forest = forests[(candidate, k)]
+                forest.set_params(n_estimators=n_estimators)
+                forest.fit(features[train_fold_indices], labels[train_fold_indices])
+                fold_scores.append(forest.score(features[val_fold_indices], labels[val_fold_indices]))
+            candidate_scores.append(np.mean(fold_scores))
+            scores.append((np.mean(fold_scores), dict(zip(keys, candidate), classifier__n_estimators=n_estimators)))
+
+        if r + 1 < len(tree_counts):
+            # stable sort, so that ties keep the order of the grid
+            order = np.argsort(-np.array(candidate_scores), kind='mergesort')
+            kept = [candidates[i] for i in order[:int(np.ceil(float(len(candidates)) / halving_factor))]]
+            for candidate in candidates:
+                if candidate not in kept:
+                    for k in range(len(folds)):
+                        del forests[(candidate, k)]
+            candidates = kept
+
+    # the first of the best scores, as GridSearchCV does
+    return max(scores, key=lambda score: score[0])[1]
@@ -3,9 +3,12 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import DataPreprocessing as dp
 import FeatureExtraction as fe
+import FeatureStore as fs
 import NeuralNetClassifier as nnc
 import RandomForestClassifier as rfc
 import ClassifierHelperFunctions as hf
+import multiprocessing
+import random
 import sys
 import os
 import time
@@ -23,8 +26,22 @@ show_val_acc = True
 sports = ['Badminton','Basketball','Foosball','Running','Skating','Walking']
 channels = 6
 pca_whiten = True
+pca_backend = 'randomized'
 trimLength = 15
+preprocessing_cache_dir = '../Data/PreprocessingCache'
+preprocessing_cache_max_bytes = 4 * 1024 ** 3
+binary_intermediate = True
+feature_store_dir = '../Data/FeatureStore'
+feature_store_max_bytes = 4 * 1024 ** 3
+num_workers = multiprocessing.cpu_count()
+feature_format = 'npy'
+feature_dtype = 'float32'
 hidden_sizes = [1024,1024]
+nn_search_mode = 'halving'
+nn_search_workers = multiprocessing.cpu_count()
+nn_input_pipeline = True
+rf_feature_set = 'fft'
+rf_search_mode = 'halving'
 
 # Variable parameters
 numSecondsPerImage_options = [15, 30]
@@ -33,6 +50,16 @@ fftJump_options = [1]
 num_pca_components_options = [100, 200]
 algo_switch_options = [0, 1, 2, 3]
 
+featureStore = fs.FeatureStore(storeDir=feature_store_dir, maxBytes=feature_store_max_bytes)
+
+# Worker processes are forked, so their pools are created before any tensorflow session exists; worker_pool is
+# shared by the pre-processing and the feature extraction
+worker_pool = None
+if num_workers > 1:
+    worker_pool = multiprocessing.Pool(num_workers)
+nn_search_pool = None
+if nn_search_mode == 'halving':
+    nn_search_pool = nnc.create_search_pool(nn_search_workers)
 
 for algoSwitch in algo_switch_options:
 
@@ -51,65 +78,116 @@ for algoSwitch in algo_switch_options:
 
         if algoSwitch <= 1:
             dp.data_preprocessing(sports=sports, secondsToKeep=numSecondsPerImage, trimLength=trimLength,
-                              switchAlgo=algoSwitch)
+                              switchAlgo=algoSwitch, cacheDir=preprocessing_cache_dir,
+                              cacheMaxBytes=preprocessing_cache_max_bytes,
+                              binaryOutput=binary_intermediate, numWorkers=num_workers,
+                              workerPool=worker_pool)
         if algoSwitch == 2:
             dp.data_preprocessing(sports=sports, secondsToKeep=numSecondsPerImage, trimLength=trimLength,
-                                  switchAlgo=0)
-            dp.data_preprocessing(sports=sports, secondsToKeep=numSecondsPerImage, trimLength=trimLength,
-                                  switchAlgo=algoSwitch)
+                                  switchAlgo=[0, algoSwitch], cacheDir=preprocessing_cache_dir,
+                                  cacheMaxBytes=preprocessing_cache_max_bytes,
+                                  binaryOutput=binary_intermediate, numWorkers=num_workers,
+                                  workerPool=worker_pool)
         if algoSwitch == 3:
             dp.data_preprocessing(sports=sports, secondsToKeep=numSecondsPerImage, trimLength=trimLength,
-                                  switchAlgo=4)
-            dp.data_preprocessing(sports=sports, secondsToKeep=numSecondsPerImage, trimLength=trimLength,
-                                  switchAlgo=algoSwitch)
-
-        for fftWidth in fftWidth_options:
-            for fftJump in fftJump_options:
-
-                fe.feature_extraction(sports=sports, numSecondsPerImage=numSecondsPerImage, fftWidth=fftWidth,
-                                      fftJump=fftJump, finalOrNew=0)
-                if algoSwitch > 1:
-                    fe.feature_extraction(sports=sports, numSecondsPerImage=numSecondsPerImage, fftWidth=fftWidth,
-                                          fftJump=fftJump, finalOrNew=1)
-
-                for num_pca_components in num_pca_components_options:
-
-                    # Derived parameters
-                    freqDims = 50 * fftWidth / 2
-                    timeDims = (numSecondsPerImage - fftWidth) / fftJump + 1
-
-                    # Log current run parameters
-                    print 'algoSwitch =', algoSwitch
-                    print 'sports =', sports
-                    print 'trimLength =', trimLength
-                    print 'numSecondsPerImage =', numSecondsPerImage
-                    print 'fftWidth =', fftWidth
-                    print 'fftJump =', fftJump
-                    print 'channels =', channels
-                    print 'num_pca_components =', num_pca_components
-                    print 'pca_whiten =', pca_whiten
-                    print 'hidden_sizes =', hidden_sizes
-                    print 'verbose =', verbose
-                    print 'show_val_acc =', show_val_acc
-                    print 'freqDims =', freqDims
-                    print 'timeDims =', timeDims
-
-                    # CLASSIFIERS
-
-                    nnc.run_neural_net_classifier(sports=sports, freqDims=freqDims, timeDims=timeDims,
-                                                  channels=channels, num_pca_components=num_pca_components,
-                                                  pca_whiten=pca_whiten, hidden_sizes=hidden_sizes, verbose=verbose,
-                                                  show_val_acc=show_val_acc, algoSwitch=algoSwitch)
-
-                    rfc.run_random_forest_classifier(sports=sports, featuresFile='../Data/featuresFinal.csv',
-                                                     labelsFile='../Data/labelsFinal.csv', freqDims=freqDims,
-                                                     timeDims=timeDims, channels=channels,
-                                                     num_pca_components=num_pca_components, pca_whiten=pca_whiten,
-                                                     algoSwitch=algoSwitch)
-
+                                  switchAlgo=[4, algoSwitch], cacheDir=preprocessing_cache_dir,
+                                  cacheMaxBytes=preprocessing_cache_max_bytes,
+                                  binaryOutput=binary_intermediate, numWorkers=num_workers,
+                                  workerPool=worker_pool)
+
+        # Extract features for every (fftWidth, fftJump) pair in one pass over the pre-processed data
+        configs = [(fftWidth, fftJump) for fftWidth in fftWidth_options for fftJump in fftJump_options]
+        featureFiles = fe.feature_extraction_multi(sports=sports, numSecondsPerImage=numSecondsPerImage,
+                                                   configs=configs, finalOrNew=0, binaryInput=binary_intermediate,
+                                                   featureStore=featureStore, numWorkers=num_workers,
+                                                   outputFormat=feature_format, featureDtype=feature_dtype,
+                                                   workerPool=worker_pool)
+        if algoSwitch > 1:
+            newPersonFeatureFiles = fe.feature_extraction_multi(sports=sports, numSecondsPerImage=numSecondsPerImage,
+                                                                configs=configs, finalOrNew=1,
+                                                                binaryInput=binary_intermediate,
+                                                                featureStore=featureStore,
+                                                                numWorkers=num_workers,
+                                                                outputFormat=feature_format,
+                                                                featureDtype=feature_dtype,
+                                                                workerPool=worker_pool)
+
+        for fftWidth, fftJump in configs:
+
+            featuresFile, secondaryFeaturesFile, labelsFile = featureFiles[(fftWidth, fftJump)]
+            newPersonFeaturesFile, newPersonSecondaryFeaturesFile, newPersonLabelsFile = None, None, None
+            if algoSwitch > 1:
+                newPersonFeaturesFile, newPersonSecondaryFeaturesFile, newPersonLabelsFile = \
+                    newPersonFeatureFiles[(fftWidth, fftJump)]
+
+            # Both classifiers and all PCA sizes get the same train/test split, so that the PCAs fitted with the
+            # largest number of components are shared by all of them
+            split_seed = random.randint(0, 2 ** 31 - 1)
+
+            for num_pca_components in num_pca_components_options:
+
+                # Derived parameters
+                freqDims = 50 * fftWidth / 2
+                timeDims = (numSecondsPerImage - fftWidth) / fftJump + 1
+
+                # Log current run parameters
+                print 'algoSwitch =', algoSwitch
+                print 'sports =', sports
+                print 'trimLength =', trimLength
+                print 'numSecondsPerImage =', numSecondsPerImage
+                print 'fftWidth =', fftWidth
+                print 'fftJump =', fftJump
+                print 'channels =', channels
+                print 'num_pca_components =', num_pca_components
+                print 'pca_whiten =', pca_whiten
+                print 'pca_backend =', pca_backend
+                print 'hidden_sizes =', hidden_sizes
+                print 'nn_search_mode =', nn_search_mode
+                print 'rf_feature_set =', rf_feature_set
+                print 'rf_search_mode =', rf_search_mode
+                print 'split_seed =', split_seed
+                print 'verbose =', verbose
+                print 'show_val_acc =', show_val_acc
+                print 'freqDims =', freqDims
+                print 'timeDims =', timeDims
+
+                # CLASSIFIERS
+
+                nnc.run_neural_net_classifier(sports=sports, featuresFile=featuresFile, labelsFile=labelsFile,
+                                              newPersonFeaturesFile=newPersonFeaturesFile,
+                                              newPersonLabelsFile=newPersonLabelsFile, freqDims=freqDims,
+                                              timeDims=timeDims, channels=channels,
+                                              num_pca_components=num_pca_components, pca_whiten=pca_whiten,
+                                              pca_fit_components=max(num_pca_components_options),
+                                              pca_backend=pca_backend, split_seed=split_seed,
+                                              hidden_sizes=hidden_sizes, verbose=verbose,
+                                              show_val_acc=show_val_acc, algoSwitch=algoSwitch,
+                                              search_mode=nn_search_mode, search_pool=nn_search_pool,
+                                              input_pipeline=nn_input_pipeline)
+
+                rfc.run_random_forest_classifier(sports=sports, featuresFile=featuresFile, labelsFile=labelsFile,
+                                                 newPersonFeaturesFile=newPersonFeaturesFile,
+                                                 newPersonLabelsFile=newPersonLabelsFile,
+                                                 secondaryFeaturesFile=secondaryFeaturesFile,
+                                                 newPersonSecondaryFeaturesFile=newPersonSecondaryFeaturesFile,
+                                                 freqDims=freqDims,
+                                                 timeDims=timeDims, channels=channels,
+                                                 num_pca_components=num_pca_components, pca_whiten=pca_whiten,
+                                                 pca_fit_components=max(num_pca_components_options),
+                                                 pca_backend=pca_backend, split_seed=split_seed, algoSwitch=algoSwitch,
+                                                 featureSet=rf_feature_set, search_mode=rf_search_mode)
+
+            # Both classifiers are done with the features of this configuration, so the store may evict them
+            featureStore.release([featuresFile, secondaryFeaturesFile, labelsFile, newPersonFeaturesFile,
+                                  newPersonSecondaryFeaturesFile, newPersonLabelsFile])
 
     ################################################################
     # !!! RESETTING STDOUT LOGGING !!!
     # Stop redirecting pring out to log
     logger.close_log()
     sys.stdout = orig_stdout
+
+for pool in [worker_pool, nn_search_pool]:
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import NeuralNetModel as nnmodel
+
+
+class BatchedNeuralNetModelTest(unittest.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        rng = np.random.RandomState(0)
+        self.features = rng.randn(230, 8, 2).astype(np.float32)
+        self.labels = np.eye(3)[rng.randint(3, size=230)].astype(np.float32)
+        self.short_mask = np.arange(230) < 130
+        self.long_mask = np.ones(230, dtype=bool)
+
+        self.sess = tf.Session()
+        self.batched_model = nnmodel.BatchedNeuralNetModel(sess=self.sess, num_models=2, num_components=8,
+                                                           channels=2, num_classes=3, hidden_sizes=[16, 16])
+        self.model = nnmodel.NeuralNetModel(sess=self.sess, num_components=8, channels=2, num_classes=3,
+                                            hidden_sizes=[16, 16])
+        self.batched_weights = [self.batched_model.W_fc1, self.batched_model.b_fc1, self.batched_model.W_fc2,
+                                self.batched_model.b_fc2, self.batched_model.W_fc3, self.batched_model.b_fc3]
+        self.weights = [self.model.W_fc1, self.model.b_fc1, self.model.W_fc2, self.model.b_fc2,
+                        self.model.W_fc3, self.model.b_fc3]
+        self.initial_weights = self.sess.run(self.batched_weights)
+
+    def tearDown(self):
+        self.sess.close()
+
+    def train_batched(self, masks):
+        self.batched_model.reset()
+        for weight, value in zip(self.batched_weights, self.initial_weights):
+            self.sess.run(weight.assign(value))
+        self.batched_model.train(self.features, self.labels, np.array(masks), learning_rates=[1e-2, 3e-3],
+                                 keep_probs=[1.0, 1.0], batch_size=25, num_epochs=3, verbose=False)
+        return self.sess.run(self.batched_weights)
+
+    def test_models_do_not_affect_each_other(self):
+        alone = self.train_batched([self.short_mask, self.short_mask])
+        beside_longer = self.train_batched([self.short_mask, self.long_mask])
+        for first, second in zip(alone, beside_longer):
+            self.assertTrue(np.array_equal(first[0], second[0]))
+
+    def test_same_steps_as_single_model(self):
+        batched = self.train_batched([self.short_mask, self.long_mask])
+
+        self.model.reset()
+        for weight, value in zip(self.weights, self.initial_weights):
+            self.sess.run(weight.assign(value[0].reshape(weight.get_shape().as_list())))
+        self.model.train(self.features, self.labels, learning_rate=1e-2, keep_prob=1.0, batch_size=25, num_epochs=3,
+                         verbose=False, indices=np.flatnonzero(self.short_mask))
+
+        for batched_weight, weight in zip(batched, self.sess.run(self.weights)):
+            self.assertTrue(np.allclose(batched_weight[0].reshape(weight.shape), weight, atol=1e-5))
+
+
+class NeuralNetModelTest(unittest.TestCase):
+
+    def test_input_pipeline_keeps_loaded_data(self):
+        tf.reset_default_graph()
+        rng = np.random.RandomState(0)
+        features = rng.randn(120, 8, 2).astype(np.float32)
+        labels = np.eye(3)[rng.randint(3, size=120)].astype(np.float32)
+        indices = np.flatnonzero(np.arange(120) % 3 != 0)
+
+        with tf.Session() as sess:
+            model = nnmodel.NeuralNetModel(sess=sess, num_components=8, channels=2, num_classes=3,
+                                           hidden_sizes=[16, 16])
+            weights = [model.W_fc1, model.b_fc1, model.W_fc2, model.b_fc2, model.W_fc3, model.b_fc3]
+            model.load_data(features, labels)
+            model.reset()
+            initial_weights = sess.run(weights)
+
+            # the arrays are not passed again: the pipeline trains on the data loaded before the reset
+            model.train(None, None, learning_rate=1e-2, keep_prob=1.0, batch_size=25, num_epochs=2, verbose=False,
+                        indices=indices, input_pipeline=True, shuffle=False)
+            pipeline_weights = sess.run(weights)
+
+            model.reset()
+            for weight, value in zip(weights, initial_weights):
+                sess.run(weight.assign(value))
+            model.train(features, labels, learning_rate=1e-2, keep_prob=1.0, batch_size=25, num_epochs=2,
+                        verbose=False, indices=indices)
+            fed_weights = sess.run(weights)
+
+        for pipeline_weight, fed_weight in zip(pipeline_weights, fed_weights):
+            self.assertTrue(np.allclose(pipeline_weight, fed_weight, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
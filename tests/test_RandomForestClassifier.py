@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import FeatureExtractionHelperFunctions as fehp
+import RandomForestClassifier as rfc
+
+
+class FiniteFeaturesTest(unittest.TestCase):
+
+    def test_constant_zero_channel(self):
+        # channel 0 is constant zero (NaN statistics), channel 1 alternates around zero (infinite coefficient of
+        # variation) and channel 2 is noise
+        rng = np.random.RandomState(0)
+        windows = rng.randn(20, 3, 50, 3)
+        windows[..., 0] = 0
+        windows[..., 1] = np.where(np.arange(50) % 2 == 0, 1.0, -1.0)
+        statistics = fehp.statistical_features(windows)
+        features = statistics.reshape((-1, statistics.shape[-1])).T
+        self.assertTrue(np.isnan(features).any())
+        self.assertTrue(np.isinf(features).any())
+
+        finite = rfc.finite_features(features)
+        self.assertTrue(np.isfinite(finite).all())
+        self.assertTrue(np.array_equal(finite[np.isfinite(features)], features[np.isfinite(features)]))
+        self.assertTrue((finite[~np.isfinite(features)] == 0).all())
+
+        labels = np.arange(features.shape[0]) % 2
+        RandomForestClassifier(n_estimators=5, random_state=0).fit(finite, labels)
+
+
+if __name__ == '__main__':
+    unittest.main()